@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+from time import time
+
+import cleanup
+
+def touch(path, size=0, sparse=False, mtime=None):
+  with open(path, "wb") as f:
+    if sparse:
+      f.truncate(size)
+    elif size:
+      f.write(b"x" * size)
+  if mtime is not None:
+    os.utime(path, (mtime, mtime))
+
+def makedirs(path):
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  return path
+
+def generate_tree(root, scale=100, file_size=1024, hprof_size=2*1024**3, hprof_count=2, upgrade_depth=4):
+  now = time()
+  files = 0
+
+  # CVP service logs with their rotations
+  services = {
+    "cvpi/logs": ["cvpi", "cvpi_config"],
+    "cvpi/hadoop/logs": ["hadoop-cvp-namenode", "hadoop-cvp-datanode"],
+    "cvpi/hbase/logs": ["hbase-cvp-master", "hbase-cvp-regionserver"],
+    "cvpi/apps/turbine/logs": ["turbine"],
+    "cvpi/apps/aeris/logs": ["aeris", "ingest"],
+    "cvpi/apps/cvp/logs": ["cvp"],
+  }
+  for directory, names in services.items():
+    directory = makedirs(os.path.join(root, directory))
+    for name in names:
+      for suffix in ["log", "out", "gc"]:
+        touch(os.path.join(directory, "%s.%s" % (name, suffix)), file_size)
+        files += 1
+        for n in range(1, scale + 1):
+          touch(os.path.join(directory, "%s.%s.%s" % (name, suffix, n)), file_size, mtime=now - n * 3600)
+          files += 1
+
+  # /var/log with system rotations and kubelet INFO/WARNING/ERROR logs
+  var_log = makedirs(os.path.join(root, "var/log"))
+  for name in ["messages", "secure", "cron", "maillog"]:
+    touch(os.path.join(var_log, name), file_size)
+    for n in range(1, scale + 1):
+      touch(os.path.join(var_log, "%s-%s.gz" % (name, n)), file_size, mtime=now - n * 86400)
+      touch(os.path.join(var_log, "%s.%s" % (name, n % 10)), file_size, mtime=now - n * 86400)
+      files += 2
+  for level in ["INFO", "WARNING", "ERROR"]:
+    for n in range(scale * 3):
+      stamp = datetime.fromtimestamp(now - n * 600).strftime("%Y%m%d-%H%M%S")
+      touch(os.path.join(var_log, "kubelet.cvp.root.log.%s.%s.%s" % (level, stamp, 1000 + n)), file_size, mtime=now - n * 600)
+      files += 1
+  for n in range(scale):
+    subdir = makedirs(os.path.join(var_log, "pods", "pod-%s" % (n % 10), "container"))
+    touch(os.path.join(subdir, "%s.log.gz" % n), file_size)
+    files += 1
+
+  # Crash dumps, docker images and RPMs
+  for n in range(max(1, scale // 20)):
+    crash = makedirs(os.path.join(root, "var/crash", "127.0.0.1-%s" % n))
+    touch(os.path.join(crash, "vmcore"), file_size * 10)
+    files += 1
+  docker = makedirs(os.path.join(root, "cvpi/docker"))
+  rpms = makedirs(os.path.join(root, "RPMS"))
+  for n in range(max(1, scale // 10)):
+    touch(os.path.join(docker, "image-%s.tar.gz" % n), file_size * 10)
+    touch(os.path.join(rpms, "package-%s.rpm" % n), file_size * 10)
+    files += 2
+
+  # Sparse multi-GB heap dumps
+  for directory in ["cvpi/apps/aeris/elasticsearch", "home/cvp"]:
+    directory = makedirs(os.path.join(root, directory))
+    for n in range(hprof_count):
+      touch(os.path.join(directory, "java_pid%s.hprof" % (1000 + n)), hprof_size, sparse=True)
+      files += 1
+
+  # Nested temporary upgrade directories
+  for n in range(2):
+    directory = os.path.join(root, "tmp", "upgrade%s" % n)
+    for depth in range(upgrade_depth):
+      directory = makedirs(os.path.join(directory, "level%s" % depth))
+      for m in range(max(1, scale // 10)):
+        touch(os.path.join(directory, "file%s" % m), file_size)
+        files += 1
+  return files
+
+def redirect(root, directories):
+  return [os.path.join(root, directory.lstrip("/")) for directory in directories]
+
+def build_categories(root, log, index, pool):
+  # The built-in categories of cleanup.py, rooted in the synthetic tree
+  registry = cleanup.CategoryRegistry()
+  for entry in registry.entries:
+    entry['directories'] = redirect(root, entry['directories'])
+  return registry.build(log=log, index=index, pool=pool)
+
+def run(args, log):
+  root = tempfile.mkdtemp(prefix="cvp-cleanup-bench-", dir=args.directory)
+  try:
+    start = time()
+    files = generate_tree(root, scale=args.scale, file_size=args.file_size, hprof_size=args.hprof_size)
+    log.info("Generated %s files under %s in %.2fs" % (files, root, time() - start))
+
+    cleanup.metrics = cleanup.Metrics()
+    index = cleanup.DirectoryIndex(log=log)
+    pool = cleanup.DeletionPool(workers=args.delete_workers, log=log)
+    timings = {}
+
+    start = time()
+    categories = build_categories(root, log, index, pool)
+    timings['construct'] = time() - start
+
+    # Files scans lazily, so the first access to its results does the work
+    start = time()
+    for category in categories:
+      category.files
+    timings['scan'] = sum(phase['seconds'] for (name, category), phase in cleanup.metrics.phases.items() if name == 'scan')
+    timings['size'] = sum(phase['seconds'] for (name, category), phase in cleanup.metrics.phases.items() if name == 'size')
+    timings['scan_and_size'] = time() - start
+
+    start = time()
+    freed = 0
+    for category in categories:
+      freed += category.auto_delete_files()
+    timings['delete'] = time() - start
+
+    return {
+      'files': files,
+      'freed': freed,
+      'timings': timings,
+      'phases': [dict(phase=name, category=category, **cleanup.metrics.phases[(name, category)]) for name, category in cleanup.metrics.order],
+    }
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+def summarize(runs):
+  summary = {}
+  for key in runs[0]['timings']:
+    values = sorted(run['timings'][key] for run in runs)
+    summary[key] = {'min': values[0], 'median': values[len(values) // 2], 'max': values[-1]}
+  return summary
+
+def compare(summary, baseline):
+  print("%-16s %12s %12s %8s" % ("Timing", "Baseline", "Current", "Change"))
+  for key, values in sorted(summary.items()):
+    if key not in baseline:
+      continue
+    before = baseline[key]['median']
+    after = values['median']
+    change = (after - before) / before * 100 if before else 0
+    print("%-16s %11.4fs %11.4fs %+7.1f%%" % (key, before, after, change))
+
+def check_args():
+  parser = argparse.ArgumentParser(description="Benchmark cleanup.py scanning and deletion on a synthetic CVP filesystem tree.")
+  parser.add_argument("--scale", default=100, type=int, help="Rotations per log file, other file counts scale with it. Default: 100")
+  parser.add_argument("--file-size", default=1024, type=cleanup.parse_size, help="Size of each regular file. Default: 1K")
+  parser.add_argument("--hprof-size", default="2G", type=cleanup.parse_size, help="Apparent size of each sparse heap dump. Default: 2G")
+  parser.add_argument("--repeat", default=3, type=int, help="Number of runs, each on a freshly generated tree. Default: 3")
+  parser.add_argument("--delete-workers", default=1, type=int, help="Threads used by delete_files. Default: 1")
+  parser.add_argument("--directory", default=None, type=str, help="Where the synthetic tree is created. Default: the system temporary directory")
+  parser.add_argument("--output", default=None, type=str, help="Save the results to this JSON file")
+  parser.add_argument("--compare", default=None, type=str, help="Compare the results with a JSON file saved by a previous run")
+  parser.add_argument("--verbose", "-v", action="store_true", default=False, help="Print progress messages")
+  return parser.parse_args()
+
+def main():
+  args = check_args()
+  logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+  log = logging.getLogger("benchmark")
+  log.setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+  runs = [run(args, log) for n in range(args.repeat)]
+  results = {
+    'timestamp': datetime.utcnow().isoformat(),
+    'python': platform.python_version(),
+    'config': {'scale': args.scale, 'file_size': args.file_size, 'hprof_size': args.hprof_size, 'repeat': args.repeat, 'delete_workers': args.delete_workers},
+    'files': runs[0]['files'],
+    'summary': summarize(runs),
+    'runs': runs,
+  }
+
+  print("%s files, %s runs" % (results['files'], args.repeat))
+  for key, values in sorted(results['summary'].items()):
+    print("%-16s min %.4fs  median %.4fs  max %.4fs" % (key, values['min'], values['median'], values['max']))
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results['summary'], json.load(f)['summary'])
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+  main()
@@ -1,17 +1,819 @@
 #!/usr/bin/env python
+from contextlib import contextmanager
 from datetime import datetime
+from fnmatch import translate
 from glob import glob as search
 import argparse
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import math
+import multiprocessing
 import os
 import re
+import select
+import shutil
+import signal
+import stat
 import subprocess
 import sys
-from time import sleep
+import threading
+import zlib
+from time import sleep, time
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+  ThreadPoolExecutor = None
+
+try:
+  from queue import Queue
+except ImportError:
+  from Queue import Queue
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+# Python 2 has no os.scandir, fall back to listdir + stat there
+try:
+  from os import scandir
+except ImportError:
+  scandir = None
+
+def list_directory(directory):
+  if scandir is not None:
+    return [(entry.name, entry.path, entry.is_dir()) for entry in scandir(directory)]
+  entries = []
+  for name in os.listdir(directory):
+    path = os.path.join(directory, name)
+    entries.append((name, path, os.path.isdir(path)))
+  return entries
+
+class PatternMatcher:
+  def __init__(self, patterns):
+    self.patterns = list(patterns)
+    regexes = []
+    for i, pattern in enumerate(self.patterns):
+      regex = translate(pattern)
+      # Python 2 appends global flags, which can't be combined into one regex
+      if regex.endswith("(?ms)"):
+        regex = regex[:-len("(?ms)")]
+      # Keep glob semantics: wildcards don't match hidden files
+      if not pattern.startswith('.'):
+        regex = r"(?!\.)" + regex
+      regexes.append("(?P<p%s>%s)" % (i, regex))
+    self.regex = re.compile("|".join(regexes), re.S)
+
+  def match(self, name):
+    match = self.regex.match(name)
+    if match is None:
+      return None
+    return self.patterns[int(match.lastgroup[1:])]
+
+class Metrics:
+  def __init__(self):
+    self.phases = {}
+    self.order = []
+    self.local = threading.local()
+
+  # Start over, e.g. for each cleanup of the daemon
+  def reset(self):
+    self.phases = {}
+    self.order = []
+
+  @contextmanager
+  def phase(self, name, category=""):
+    key = (name, category)
+    if key not in self.phases:
+      self.phases[key] = {'seconds': 0.0, 'files': 0, 'syscalls': 0, 'freed': 0}
+      self.order.append(key)
+    stack = self.local.__dict__.setdefault('stack', [])
+    stack.append(key)
+    start = time()
+    try:
+      yield self.phases[key]
+    finally:
+      self.phases[key]['seconds'] += time() - start
+      stack.pop()
+
+  # Counts go to the innermost phase running in the calling thread
+  def count(self, counter, value=1):
+    stack = self.local.__dict__.get('stack')
+    if stack:
+      self.phases[stack[-1]][counter] += value
+
+  def write_prometheus(self, path, log=None):
+    def labels(key):
+      values = [value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in key]
+      return 'phase="%s",category="%s"' % tuple(values)
+    lines = []
+    for metric, counter, kind, text in [
+        ("cvp_cleanup_phase_duration_seconds", 'seconds', "gauge", "Time spent in each cleanup phase during the last cleanup run"),
+        ("cvp_cleanup_files_visited", 'files', "gauge", "Directory entries visited in each cleanup phase during the last cleanup run"),
+        ("cvp_cleanup_syscalls", 'syscalls', "gauge", "Filesystem calls issued in each cleanup phase during the last cleanup run"),
+        ("cvp_cleanup_freed_bytes", 'freed', "gauge", "Bytes freed in each cleanup phase during the last cleanup run")]:
+      lines.append("# HELP %s %s" % (metric, text))
+      lines.append("# TYPE %s %s" % (metric, kind))
+      for key in self.order:
+        lines.append("%s{%s} %s" % (metric, labels(key), self.phases[key][counter]))
+    lines.append("# HELP cvp_cleanup_last_run_timestamp_seconds When the last cleanup run finished")
+    lines.append("# TYPE cvp_cleanup_last_run_timestamp_seconds gauge")
+    lines.append("cvp_cleanup_last_run_timestamp_seconds %s" % time())
+    # node_exporter may read the file at any time, never let it see a partial one
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    try:
+      with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+      os.rename(tmp, path)
+    except (IOError, OSError) as e:
+      log.warning("Could not write metrics to %s: %s" % (path, e))
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+
+  def report(self):
+    print("%-12s %-32s %10s %10s %10s %10s" % ("Phase", "Category", "Seconds", "Files", "Syscalls", "Freed"))
+    for key in self.order:
+      phase = self.phases[key]
+      print("%-12s %-32s %10.3f %10s %10s %10s" % (key[0], key[1] or "-", phase['seconds'], phase['files'], phase['syscalls'], convert_size(phase['freed'])))
+
+metrics = Metrics()
+
+class StaleCacheError(Exception):
+  pass
+
+class ScanCache:
+  version = 1
+
+  def __init__(self, path, log=None):
+    self.path = path
+    self.log = log
+    self.directories = {}
+    self.hits = 0
+    self.misses = 0
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.path) as f:
+        data = json.load(f)
+      if data.get('version') != self.version:
+        raise ValueError("unsupported version %s" % data.get('version'))
+      self.directories = data['directories']
+      self.log.debug("Loaded scan cache %s (%s directories)" % (self.path, len(self.directories)))
+    except (IOError, OSError):
+      self.directories = {}
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      self.log.warning("Ignoring invalid scan cache %s: %s" % (self.path, e))
+      self.directories = {}
+
+  def save(self):
+    tmp = "%s.%s.tmp" % (self.path, os.getpid())
+    try:
+      directory = os.path.dirname(self.path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      with open(tmp, "w") as f:
+        json.dump({'version': self.version, 'directories': self.directories}, f, separators=(',', ':'))
+      os.rename(tmp, self.path)
+      self.log.debug("Saved scan cache %s (%s hits, %s misses)" % (self.path, self.hits, self.misses))
+    except (IOError, OSError) as e:
+      self.log.warning("Could not save scan cache %s: %s" % (self.path, e))
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+
+  def __key(self, st):
+    return [getattr(st, 'st_mtime_ns', st.st_mtime), st.st_dev, st.st_ino]
+
+  def get(self, directory, st):
+    cached = self.directories.get(directory)
+    if cached is None or cached[:3] != self.__key(st):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return [(name, os.path.join(directory, name), is_dir) for name, is_dir in cached[3]]
+
+  def put(self, directory, st, entries):
+    # A directory modified within the last seconds may change again without
+    # its mtime moving, so don't trust its listing on the next run
+    if time() - st.st_mtime < 2:
+      self.directories.pop(directory, None)
+      return
+    self.directories[directory] = self.__key(st) + [[[name, is_dir] for name, path, is_dir in entries]]
+
+  def prune(self, root, visited):
+    prefix = root.rstrip("/") + "/"
+    for directory in list(self.directories):
+      if (directory == root or directory.startswith(prefix)) and directory not in visited:
+        del self.directories[directory]
+
+  def clear(self):
+    self.directories = {}
+
+def walk(root, recursive=True, log=None, cache=None, visited=None):
+  seen = set()
+  stack = [(root, 0, False)]
+  while stack:
+    directory, depth, cached = stack.pop()
+    metrics.count('syscalls')
+    try:
+      st = os.stat(directory)
+    except OSError:
+      # Listed by the cache, but gone without its parent's mtime changing
+      if cached:
+        raise StaleCacheError(directory)
+      continue
+    if (st.st_dev, st.st_ino) in seen:
+      continue
+    seen.add((st.st_dev, st.st_ino))
+    if visited is not None:
+      visited.add(directory)
+    entries = cache.get(directory, st) if cache is not None else None
+    from_cache = entries is not None
+    if entries is None:
+      metrics.count('syscalls')
+      try:
+        entries = list_directory(directory)
+      except OSError as e:
+        if log:
+          log.debug("Could not list %s: %s" % (directory, e))
+        continue
+      if cache is not None:
+        cache.put(directory, st, entries)
+    for name, path, is_dir in entries:
+      yield name, path, depth, is_dir
+      if recursive and is_dir and not name.startswith('.'):
+        stack.append((path, depth + 1, from_cache))
+
+class DirectoryIndex:
+  def __init__(self, log=None, cache=None):
+    self.log = log
+    self.cache = cache
+    self.trees = {}
+    self.stats = {}
+    self.categories = []
+    self.pending = {}
+    # Held by categories while they scan or change the index, so a
+    # background scan and the main thread don't step on each other
+    self.lock = threading.RLock()
+
+  def entries(self, root, recursive=True):
+    tree = self.trees.get(root)
+    if tree is None or (recursive and not tree[0]):
+      self.log.debug("Scanning %s" % root)
+      tree = (recursive, self.__walk(root, recursive))
+      self.trees[root] = tree
+    return tree[1]
+
+  def __walk(self, root, recursive):
+    if self.cache is None:
+      return list(walk(root, recursive, log=self.log))
+    visited = set()
+    try:
+      entries = list(walk(root, recursive, log=self.log, cache=self.cache, visited=visited))
+    except StaleCacheError as e:
+      self.log.warning("Scan cache is inconsistent (%s is gone), rescanning" % e)
+      self.cache.clear()
+      visited = set()
+      entries = list(walk(root, recursive, log=self.log, cache=self.cache, visited=visited))
+    if recursive:
+      self.cache.prune(root, visited)
+    return entries
+
+  def save(self):
+    if self.cache is not None:
+      self.cache.save()
+
+  def register(self, category):
+    self.categories.append(category)
+
+  # Categories rooted in the same directory that haven't been scanned yet are
+  # matched together, in a single pass over the directory
+  def matches(self, category):
+    if category not in self.pending:
+      roots = set(category.scan_roots())
+      self.__match([other for other in self.categories if other is category or (other not in self.pending and 'files' not in other.__dict__ and roots.intersection(other.scan_roots()))])
+    # Leave out files removed since the pass, e.g. by an overlapping category
+    return [result for result in self.pending.pop(category) if self.lstat(result[0]) is not None]
+
+  # Matches of a single category, yielded while its roots are walked instead
+  # of after a full pass. Trees already walked are reused, new walks are not
+  # kept: the dry run reads each tree once. scan_roots don't overlap, so no
+  # path comes out twice
+  def stream(self, category):
+    for root in category.scan_roots():
+      tree = self.trees.get(root)
+      if tree is not None and (tree[0] or not category.config['recursive']):
+        entries = tree[1]
+      else:
+        self.log.debug("Scanning %s" % root)
+        entries = walk(root, category.config['recursive'], log=self.log)
+      for name, path, depth, is_dir in entries:
+        metrics.count('files')
+        if depth > 0 and not category.config['recursive']:
+          continue
+        pattern = category.matcher.match(name)
+        if pattern is None:
+          continue
+        # Not kept in self.stats, memory stays flat however many files match
+        metrics.count('syscalls')
+        try:
+          st = os.lstat(path)
+        except OSError:
+          continue
+        yield path, st, pattern
+
+  def __match(self, group):
+    roots = []
+    by_root = {}
+    for category in group:
+      self.pending[category] = []
+      for root in category.scan_roots():
+        if root not in by_root:
+          roots.append(root)
+          by_root[root] = []
+        by_root[root].append(category)
+    for root in roots:
+      categories = by_root[root]
+      recursive = any(category.config['recursive'] for category in categories)
+      # Names matching none of the patterns are ruled out with a single regex
+      matcher = None
+      if len(categories) > 1:
+        matcher = PatternMatcher(sorted(set(pattern for category in categories for pattern in category.config['prefixes'])))
+      for name, path, depth, is_dir in self.entries(root, recursive):
+        metrics.count('files')
+        if matcher is not None and matcher.match(name) is None:
+          continue
+        matched = []
+        for category in categories:
+          if depth > 0 and not category.config['recursive']:
+            continue
+          pattern = category.matcher.match(name)
+          if pattern is not None:
+            matched.append((category, pattern))
+        if not matched:
+          continue
+        st = self.lstat(path)
+        if st is None:
+          continue
+        for category, pattern in matched:
+          self.pending[category].append((path, st, pattern))
+
+  def lstat(self, path):
+    if path not in self.stats:
+      metrics.count('syscalls')
+      try:
+        self.stats[path] = os.lstat(path)
+      except OSError:
+        self.stats[path] = None
+    return self.stats[path]
+
+  def forget(self, paths):
+    for path in paths:
+      self.stats[path] = None
+
+  def invalidate(self, roots=None):
+    if roots is None:
+      self.trees = {}
+      self.stats = {}
+      self.pending = {}
+      return
+    for category in list(self.pending):
+      if set(roots).intersection(category.scan_roots()):
+        del self.pending[category]
+    for root in roots:
+      self.trees.pop(root, None)
+    for path in list(self.stats):
+      for root in roots:
+        if path == root or path.startswith(root.rstrip("/") + "/"):
+          del self.stats[path]
+          break
+
+def allocated_size(stats):
+  size = 0
+  seen = set()
+  for st in stats.values():
+    if (st.st_dev, st.st_ino) not in seen:
+      seen.add((st.st_dev, st.st_ino))
+      size += st.st_blocks * 512
+  return size
+
+def freed_size(removed):
+  links = {}
+  for st in removed.values():
+    key = (st.st_dev, st.st_ino)
+    links[key] = links.get(key, 0) + 1
+  size = 0
+  for key, st in dict(((st.st_dev, st.st_ino), st) for st in removed.values()).items():
+    # Blocks are only released once the last link to an inode is gone
+    if stat.S_ISDIR(st.st_mode) or links[key] >= st.st_nlink:
+      size += st.st_blocks * 512
+  return size
+
+def mount_point(path):
+  path = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+  while path != "/":
+    parent = os.path.dirname(path)
+    try:
+      if os.lstat(parent).st_dev != os.lstat(path).st_dev:
+        break
+    except OSError:
+      pass
+    path = parent
+  return path
+
+def free_bytes(path):
+  st = os.statvfs(path)
+  return st.f_bfree * st.f_frsize
+
+# I/O scheduling classes, as printed and taken by ionice
+IONICE_CLASSES = {"none": "0", "realtime": "1", "best-effort": "2", "idle": "3"}
+
+class DeletionPool:
+  def __init__(self, workers=1, gentle_threshold=None, gentle_rate=50*1024*1024, idle_io=False, log=None):
+    self.workers = max(1, int(workers))
+    self.gentle_threshold = gentle_threshold
+    self.gentle_rate = gentle_rate
+    self.idle_io = idle_io
+    self.log = log
+    if self.workers > 1 and ThreadPoolExecutor is None:
+      self.log.warning("concurrent.futures is not available, deleting with a single worker")
+      self.workers = 1
+
+  def plan(self, paths, directories=[], stats={}):
+    files = []
+    dirs = {}
+    planned = {}
+    for path in list(paths) + [d for d in directories if d not in stats]:
+      if path in planned:
+        continue
+      st = stats.get(path) or self.__lstat(path)
+      if st is None:
+        continue
+      planned[path] = st
+      if stat.S_ISDIR(st.st_mode):
+        self.__expand(path, files, dirs, planned)
+      else:
+        files.append(path)
+    return files, dirs, planned
+
+  def __lstat(self, path):
+    metrics.count('syscalls')
+    try:
+      return os.lstat(path)
+    except OSError:
+      return None
+
+  def __expand(self, directory, files, dirs, planned):
+    dirs.setdefault(directory.rstrip("/").count("/"), []).append(directory)
+    for dirpath, dirnames, filenames in os.walk(directory):
+      for name in dirnames + filenames:
+        path = os.path.join(dirpath, name)
+        if path in planned:
+          continue
+        st = self.__lstat(path)
+        if st is None:
+          continue
+        planned[path] = st
+        # os.walk doesn't follow symlinked directories, so those are removed as links
+        if stat.S_ISDIR(st.st_mode):
+          dirs.setdefault(path.count("/"), []).append(path)
+        else:
+          files.append(path)
+
+  def __remove(self, args):
+    function, path = args
+    try:
+      function(path)
+      return path, None
+    except OSError as e:
+      return path, e
+
+  def __run(self, function, paths):
+    jobs = [(function, path) for path in paths]
+    if self.workers == 1 or len(jobs) < 2:
+      return [self.__remove(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(self.__remove, jobs))
+
+  # Idle I/O priority (with idle_io) for the duration of the block only, the
+  # rest of the run keeps the priority it was started with
+  @contextmanager
+  def __idle_io(self):
+    if not self.idle_io:
+      yield
+      return
+    pid = str(os.getpid())
+    try:
+      previous = subprocess.check_output(["ionice", "-p", pid]).decode().strip()
+      subprocess.check_call(["ionice", "-c", "3", "-p", pid])
+      self.log.debug("Switched from %s to idle I/O priority" % previous)
+    except (OSError, subprocess.CalledProcessError) as e:
+      self.log.warning("Could not switch to idle I/O priority: %s" % e)
+      yield
+      return
+    try:
+      yield
+    finally:
+      # ionice prints e.g. "best-effort: prio 4", "idle" or "none: prio 0"
+      name, _, level = previous.partition(": prio ")
+      command = ["ionice", "-c", IONICE_CLASSES.get(name, "0")]
+      if level and name in ("realtime", "best-effort"):
+        command += ["-n", level]
+      try:
+        subprocess.check_call(command + ["-p", pid])
+        self.log.debug("Restored %s I/O priority" % previous)
+      except (OSError, subprocess.CalledProcessError) as e:
+        self.log.warning("Could not restore %s I/O priority: %s" % (previous, e))
+
+  def __truncate(self, path, size):
+    fd = os.open(path, os.O_WRONLY | getattr(os, 'O_NOFOLLOW', 0))
+    try:
+      remaining = size
+      start = time()
+      if self.gentle_rate:
+        step = max(1024 * 1024, int(self.gentle_rate / 4))
+      else:
+        step = 256 * 1024 * 1024
+      reported = 0
+      while remaining > 0:
+        remaining = max(0, remaining - step)
+        os.ftruncate(fd, remaining)
+        done = size - remaining
+        if self.gentle_rate:
+          # Sleep until the bytes released so far fit the budget
+          delay = start + float(done) / self.gentle_rate - time()
+          if delay > 0:
+            sleep(delay)
+        percent = int(done * 100 / size)
+        if percent >= reported + 10 or remaining == 0:
+          reported = percent
+          self.log.info("Truncating %s: %s%% (%s of %s)" % (path, percent, convert_size(done), convert_size(size)))
+    finally:
+      os.close(fd)
+
+  def __truncate_large(self, files):
+    large = []
+    for path in files:
+      try:
+        st = os.lstat(path)
+      except OSError:
+        continue
+      # Truncating a file with other hard links would destroy their data too
+      if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 or st.st_size < self.gentle_threshold:
+        continue
+      large.append((path, st.st_size))
+    if not large:
+      return
+    with self.__idle_io():
+      for path, size in large:
+        self.log.info("Gently truncating %s (%s) before removal" % (path, convert_size(size)))
+        try:
+          self.__truncate(path, size)
+        except OSError as e:
+          self.log.warning("Could not truncate %s: %s" % (path, e))
+
+  def delete(self, paths, directories=[], stats={}):
+    files, dirs, planned = self.plan(paths, directories, stats)
+    self.log.debug("Deleting %s files and %s directories with %s workers" % (len(files), sum(len(d) for d in dirs.values()), self.workers))
+    devices = {}
+    for path, st in planned.items():
+      devices.setdefault(st.st_dev, path)
+    mounts = {}
+    for path in devices.values():
+      mount = mount_point(path)
+      mounts[mount] = free_bytes(mount)
+    if self.gentle_threshold:
+      self.__truncate_large(files)
+    results = self.__run(os.remove, files)
+    # A directory is only removed once everything below it is gone
+    for depth in sorted(dirs, reverse=True):
+      results += self.__run(os.rmdir, dirs[depth])
+    metrics.count('syscalls', len(results))
+    metrics.count('files', len(results))
+    removed = [path for path, error in results if error is None]
+    # Already gone, e.g. removed by an overlapping category: nothing freed, nothing failed
+    failures = [(path, error) for path, error in results if error is not None and error.errno != errno.ENOENT]
+    for path, error in failures:
+      self.log.warning("Could not remove %s: %s" % (path, error))
+    freed = freed_size(dict((path, planned[path]) for path in removed))
+    for mount, before in mounts.items():
+      self.log.debug("Filesystem %s: %s free before, %s after" % (mount, convert_size(before), convert_size(free_bytes(mount))))
+    reported = sum(free_bytes(mount) - before for mount, before in mounts.items())
+    if abs(reported - freed) > max(1024 * 1024, freed / 10):
+      self.log.info("Freed %s, but filesystems report %s more free space (other writers, open files or delayed frees)" % (convert_size(freed), convert_size(reported)))
+    return removed, failures, freed
+
+class OpenFileIndex:
+  def __init__(self, log=None, proc="/proc"):
+    self.log = log
+    self.proc = proc
+    self.deleted = None
+
+  def scan(self):
+    self.deleted = {}
+    try:
+      pids = [pid for pid in os.listdir(self.proc) if pid.isdigit()]
+    except OSError as e:
+      self.log.warning("Could not list %s: %s" % (self.proc, e))
+      return
+    for pid in pids:
+      fd_dir = "%s/%s/fd" % (self.proc, pid)
+      try:
+        fds = os.listdir(fd_dir)
+      except OSError:
+        continue
+      for fd in fds:
+        try:
+          target = os.readlink("%s/%s" % (fd_dir, fd))
+        except OSError:
+          continue
+        if target.endswith(" (deleted)"):
+          self.deleted.setdefault(target[:-len(" (deleted)")], []).append((int(pid), int(fd)))
+    self.log.debug("Found %s deleted files still open" % len(self.deleted))
+
+  def under(self, roots):
+    if self.deleted is None:
+      self.scan()
+    # The fd links point to canonical paths, roots may go through symlinks or ..
+    prefixes = [os.path.realpath(root).rstrip("/") + "/" for root in roots]
+    return dict((path, holders) for path, holders in self.deleted.items() if any(path.startswith(prefix) for prefix in prefixes))
+
+  def __process_name(self, pid):
+    try:
+      with open("%s/%s/comm" % (self.proc, pid)) as f:
+        return f.read().strip()
+    except (IOError, OSError):
+      return "?"
+
+  def reclaim(self, roots):
+    with metrics.phase('reclaim-open') as phase:
+      reclaimed, failed = self.__reclaim(roots)
+      phase['freed'] += sum(reclaimed.values())
+    for pid, size in sorted(reclaimed.items()):
+      self.log.info("Reclaimed %s from deleted files held open by %s (pid %s)" % (convert_size(size), self.__process_name(pid), pid))
+    # Rescan next time, the processes may have opened or closed files since
+    self.deleted = None
+    return sum(reclaimed.values()), failed
+
+  def __reclaim(self, roots):
+    reclaimed = {}
+    truncated = set()
+    failed = 0
+    for path, holders in self.under(roots).items():
+      for pid, fd in holders:
+        fd_path = "%s/%s/fd/%s" % (self.proc, pid, fd)
+        try:
+          st = os.stat(fd_path)
+          # The " (deleted)" suffix could be part of a real name, make sure it's unlinked
+          if not stat.S_ISREG(st.st_mode) or st.st_nlink != 0:
+            continue
+          if (st.st_dev, st.st_ino) in truncated:
+            continue
+          handle = os.open(fd_path, os.O_WRONLY)
+          try:
+            os.ftruncate(handle, 0)
+          finally:
+            os.close(handle)
+        except OSError as e:
+          self.log.warning("Could not truncate deleted file %s held by pid %s: %s" % (path, pid, e))
+          failed += 1
+          continue
+        truncated.add((st.st_dev, st.st_ino))
+        self.log.debug("Truncated deleted file %s held by pid %s" % (path, pid))
+        reclaimed[pid] = reclaimed.get(pid, 0) + st.st_blocks * 512
+    return reclaimed, failed
+
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".bz2", ".xz", ".lz4", ".zip", ".Z")
+
+# What compressing a file can raise besides I/O errors
+COMPRESSION_ERRORS = (IOError, OSError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def set_niceness(niceness):
+  try:
+    os.nice(niceness)
+  except OSError:
+    pass
+
+# Returns the path, the bytes saved, the error if any, and whether the
+# compressed copy is in place
+def compress_file(args):
+  path, compression, chunk_size = args
+  target = path + (".zst" if compression == "zstd" else ".gz")
+  tmp = os.path.join(os.path.dirname(path), ".%s.%s.tmp" % (os.path.basename(target), os.getpid()))
+  try:
+    if os.path.lexists(target):
+      raise OSError(errno.EEXIST, "%s already exists" % target)
+    before = os.lstat(path)
+    with open(path, "rb") as source:
+      with open(tmp, "wb") as f:
+        writer = compressed_writer(f, compression, os.path.basename(path))
+        try:
+          while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+              break
+            writer.write(chunk)
+        finally:
+          writer.close()
+        f.flush()
+        os.fsync(f.fileno())
+    shutil.copystat(path, tmp)
+    os.chown(tmp, before.st_uid, before.st_gid)
+    compressed = os.lstat(tmp).st_blocks * 512
+    # Readers see either the original or the complete compressed file, never a partial one
+    os.rename(tmp, target)
+  except COMPRESSION_ERRORS as e:
+    try:
+      os.remove(tmp)
+    except OSError:
+      pass
+    # Compressor errors may not survive the trip back from the worker process
+    if not isinstance(e, EnvironmentError):
+      e = IOError("%s compression failed: %s" % (compression, e))
+    return path, 0, e, False
+  try:
+    os.remove(path)
+  except OSError as e:
+    return path, -compressed, e, True
+  return path, before.st_blocks * 512 - compressed, None, True
+
+class DryRunReport:
+  def __init__(self, format="text", stream=None):
+    self.format = format
+    self.stream = stream or sys.stdout
+    self.totals = {}
+    self.order = []
+    self.count = 0
+    if self.format == "json":
+      self.stream.write('{"candidates": [')
+
+  def __totals(self, category):
+    if category.name not in self.totals:
+      self.totals[category.name] = {'files': 0, 'size': 0, 'allocated': 0}
+      self.order.append(category.name)
+    return self.totals[category.name]
+
+  def add(self, category, path, st, pattern=None):
+    totals = self.__totals(category)
+    totals['files'] += 1
+    totals['size'] += st.st_size
+    totals['allocated'] += st.st_blocks * 512
+    record = {'path': path, 'category': category.name, 'size': st.st_size, 'allocated': st.st_blocks * 512, 'mtime': st.st_mtime, 'pattern': pattern}
+    if self.format == "json":
+      self.stream.write("%s\n  %s" % ("," if self.count else "", json.dumps(record, sort_keys=True)))
+    elif self.format == "ndjson":
+      record['type'] = "candidate"
+      self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+    else:
+      self.stream.write("%s\t%s\t%s\t%s\n" % (category.name, datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M"), convert_size(st.st_blocks * 512), path))
+    self.count += 1
+    self.stream.flush()
+
+  def add_files(self, category):
+    self.__totals(category)
+    # Records go out while the category is being scanned, unless the
+    # retention rules need to see every file first
+    if category.config['retention']:
+      for path in category.files:
+        self.add(category, path, category.stats[path], category.matcher.match(os.path.basename(path)))
+      return
+    with metrics.phase('scan', category.name):
+      for path, st, pattern in category.stream():
+        self.add(category, path, st, pattern)
+
+  def close(self):
+    totals = [dict(category=name, **self.totals[name]) for name in self.order]
+    if self.format == "json":
+      self.stream.write('%s],\n "totals": %s}\n' % ("\n" if self.count else "", json.dumps(totals, sort_keys=True)))
+    elif self.format == "ndjson":
+      for total in totals:
+        total['type'] = "total"
+        self.stream.write(json.dumps(total, sort_keys=True) + "\n")
+    else:
+      for total in totals:
+        self.stream.write("%s: %s files, %s\n" % (total['category'], total['files'], convert_size(total['allocated'])))
+    self.stream.flush()
 
 class Files:
-  def __init__(self, name="", directories=["./"], prefixes=["*"], recursive=True, autoconfirm=False, remove_directories=False, log=None):
+  def __init__(self, name="", directories=["./"], prefixes=["*"], recursive=True, autoconfirm=False, remove_directories=False, priority=50, retention=None, log=None, index=None, pool=None):
     self.name = name
     self.config = {}
     self.config['directories'] = directories
@@ -19,43 +821,114 @@ class Files:
     self.config['recursive'] = recursive
     self.config['autoconfirm'] = autoconfirm
     self.config['remove_directories'] = remove_directories
+    self.config['priority'] = priority
+    self.config['retention'] = retention or {}
+    self.matcher = PatternMatcher(prefixes)
     self.log = log
+    self.index = index if index is not None else DirectoryIndex(log=log)
+    self.index.register(self)
+    self.pool = pool if pool is not None else DeletionPool(log=log)
     self.previous_size = 0
-    self.reset(self.config['directories'], self.config['prefixes'], self.config['recursive'])
 
-  def reset(self, directories, prefixes, recursive):
-    self.log.debug("Initializing %s" % self.name)
-    self.files = []
-    self.size = 0
-    self.__get_files()
+  # Scan lazily, the first time the results are needed
+  def __getattr__(self, attr):
+    if attr in ('files', 'stats', 'size', 'pretty_size', 'retained'):
+      with self.index.lock:
+        # Another thread may have scanned while we waited for the lock
+        if attr not in self.__dict__:
+          self.__get_files()
+      return self.__dict__[attr]
+    raise AttributeError(attr)
+
+  def scanned(self):
+    return 'files' in self.__dict__
+
+  def reset(self, directories=None, prefixes=None, recursive=None):
+    self.log.debug("Resetting %s" % self.name)
+    with self.index.lock:
+      self.index.invalidate(self.get_roots())
+      for attr in ('files', 'stats', 'size', 'pretty_size', 'retained'):
+        self.__dict__.pop(attr, None)
+
+  def get_roots(self):
+    roots = []
+    for pattern in self.config['directories']:
+      roots += search(pattern)
+    return roots
+
+  def scan_roots(self):
+    roots = []
+    for root in self.get_roots():
+      root = os.path.normpath(root)
+      if root not in roots:
+        roots.append(root)
+    if not self.config['recursive']:
+      return roots
+    # A root inside another recursive root is walked with it
+    return [directory for directory in roots if not any(directory != root and directory.startswith(root.rstrip("/") + "/") for root in roots)]
+
+  def scan(self):
+    for path, st, pattern in self.index.matches(self):
+      yield path, st, pattern
+
+  # Like scan, but matches come out as the directories are walked
+  def stream(self):
+    for path, st, pattern in self.index.stream(self):
+      yield path, st, pattern
 
   def __get_files(self):
-    for directory in self.config['directories']:
-      for prefix in self.config['prefixes']:
-        matches = search(directory + "/" + prefix)
-        if self.config['recursive']:
-          matches += search(directory + "/" + "*/" + prefix)
-          matches += search(directory + "/" + "*/" + "*/" + prefix)
-          matches += search(directory + "/" + "*/" + "*/" + "*/" + prefix)
-          matches += search(directory + "/" + "*/" + "*/" + "*/" + "*/" + prefix)
-          matches += search(directory + "/" + "*/" + "*/" + "*/" + "*/" + "*/" + prefix)
-          matches += search(directory + "/" + "*/" + "*/" + "*/" + "*/" + "*/" + "*/" + prefix)
-        if matches:
-          self.files.append(matches)
-    self.files = self.__flatten(self.files)
-    self.size = self.__get_total_size()
+    self.log.debug("Initializing %s" % self.name)
+    files = []
+    stats = {}
+    retained = set()
+    with metrics.phase('scan', self.name):
+      for path, st, pattern in self.scan():
+        if path not in stats:
+          files.append(path)
+          stats[path] = st
+      if self.config['retention']:
+        files, retained = self.__apply_retention(files, stats)
+    with metrics.phase('size', self.name):
+      size = allocated_size(stats)
+    # Publish complete results only, other threads read them without the lock
+    self.stats = stats
+    self.retained = retained
+    self.size = size
     self.pretty_size = self.__convert_size()
+    self.files = files
     self.log.debug("Files in %s: %s" %(self.config['directories'], self.files))
 
-  def __flatten(self, list):
-    list = [item for sublist in list for item in sublist]
-    return(list)
-
-  def __get_total_size(self):
-    size = 0
-    for file in self.files:
-      size = size + os.stat(file).st_size
-    return(size)
+  def __apply_retention(self, files, stats):
+    keep_newest = self.config['retention'].get('keep_newest')
+    keep_days = self.config['retention'].get('keep_days')
+    keep_size = self.config['retention'].get('keep_size')
+    cutoff = time() - keep_days * 86400 if keep_days else None
+    kept = set()
+    kept_size = 0
+    within_size = bool(keep_size)
+    # A file is kept when any of the rules wants to keep it. Directories are
+    # left to the rules applied to the files below them
+    regular = [file for file in files if not stat.S_ISDIR(stats[file].st_mode)]
+    for n, file in enumerate(sorted(regular, key=lambda file: stats[file].st_mtime, reverse=True)):
+      st = stats[file]
+      if within_size:
+        kept_size += st.st_blocks * 512
+        within_size = kept_size <= keep_size
+      if (keep_newest and n < keep_newest) or (cutoff and st.st_mtime >= cutoff) or within_size:
+        kept.add(file)
+    # Directories holding a kept file, which can't be removed as a whole
+    retained = set()
+    for file in kept:
+      directory = os.path.dirname(file)
+      while directory not in retained and directory not in ("/", ""):
+        retained.add(directory)
+        directory = os.path.dirname(directory)
+    if kept:
+      self.log.debug("%s: keeping %s files per retention rules %s" % (self.name, len(kept), self.config['retention']))
+      files = [file for file in files if file not in kept and file not in retained]
+      for file in kept | retained:
+        stats.pop(file, None)
+    return files, retained
 
   def __convert_size(self):
     if self.size == 0:
@@ -66,33 +939,18 @@ class Files:
     s = round(self.size / p, 2)
     return "%s %s" % (s, size_name[i])
 
-  def __rmdir(self, directory):
-    try:
-      d = os.listdir(directory)
-      for item in d:
-          item = directory + "/" + item
-          if os.path.isdir(item):
-              self.__rmdir(item)
-          elif os.path.isfile(item) or os.path.islink(item):
-              os.remove(item)
-              break
-      for item in d:
-        rmdir = directory + "/" + item
-        if os.path.isdir(rmdir):
-          os.rmdir(rmdir)
-      try:
-        os.rmdir(directory)
-      except:
-        pass
-    except:
-      if self.config['remove_directories']:
-        matches = search(directory)
-        for match in matches:
-          os.rmdir(match)
-
   def list(self):
     return(self.files)
 
+  def matches(self, path):
+    if self.matcher.match(os.path.basename(path)) is None:
+      return False
+    for root in self.get_roots():
+      root = root.rstrip("/")
+      if path.startswith(root + "/"):
+        return self.config['recursive'] or os.path.dirname(path) == root
+    return False
+
   def delete_files(self):
     if not self.config['autoconfirm']:
       confirm = input("This will clean %s and cannot be undone. Are you sure you want to continue? (y/N) " %self.name)
@@ -100,26 +958,83 @@ class Files:
       confirm = 'y'
     if confirm.lower() == "y" or confirm.lower() == "yes" or self.config['autoconfirm']:
       self.log.warning("Removing %s" % self.name)
-      for file in self.files:
-        self.log.debug("Removing " + file)
-        if os.path.isfile(file) or os.path.islink(file):
-          try:
-            os.remove(file)
-          except Exception as e:
-            self.log.warning("Could not remove %s: %s" % (file, e))
-        elif os.path.isdir(file):
-          self.__rmdir(file)
-        else:
-          self.log.debug("Not removing file " + file + ".")
-      if self.config['remove_directories']:
-        for directory in self.config['directories']:
-          self.__rmdir(directory)
-
-    self.previous_size = self.size
-    self.reset(self.config['directories'], self.config['prefixes'], self.config['recursive'])
+      self.previous_size = self.size
+      directories = [root for root in self.get_roots() if root.rstrip("/") not in self.retained] if self.config['remove_directories'] else []
+      with metrics.phase('delete', self.name) as phase:
+        removed, failures, freed = self.pool.delete(self.files, directories, self.stats)
+        phase['freed'] += freed
+      if failures:
+        self.log.warning("%s: could not remove %s of %s entries" % (self.name, len(failures), len(removed) + len(failures)))
+      self.forget(removed)
+    else:
+      freed = 0
 
     # Return freed space
-    return(self.previous_size - self.size)
+    return(freed)
+
+  def forget(self, paths):
+    with self.index.lock:
+      self.index.forget(paths)
+      paths = set(paths)
+      self.files = [file for file in self.files if file not in paths]
+      removed = {}
+      for path in paths:
+        st = self.stats.pop(path, None)
+        if st is not None:
+          removed[path] = st
+      # Hard links still listed keep their blocks, which is rare enough to
+      # look for only when a removed inode had several links
+      linked = set((st.st_dev, st.st_ino) for st in removed.values() if st.st_nlink > 1)
+      if linked:
+        linked &= set((st.st_dev, st.st_ino) for st in self.stats.values())
+      self.size -= allocated_size(dict((path, st) for path, st in removed.items() if (st.st_dev, st.st_ino) not in linked))
+      self.pretty_size = self.__convert_size()
+
+  def compress_files(self, workers=None, niceness=19, compression="gzip", min_age=60):
+    if compression == "zstd" and zstandard is None:
+      self.log.warning("zstandard module is not available, compressing with gzip")
+      compression = "gzip"
+    files = []
+    for file in self.files:
+      st = self.stats[file]
+      # Only plain files nobody is writing to, and that aren't compressed already
+      if stat.S_ISREG(st.st_mode) and st.st_nlink == 1 and st.st_size > 0 and not file.endswith(COMPRESSED_SUFFIXES) and time() - st.st_mtime >= min_age:
+        files.append(file)
+    if not files:
+      return 0
+    workers = workers or available_cpus()
+    self.log.warning("Compressing %s files of %s with %s workers" % (len(files), self.name, workers))
+    saved = 0
+    failures = 0
+    kept = 0
+    pool = multiprocessing.Pool(processes=min(workers, len(files)), initializer=set_niceness, initargs=(niceness,))
+    try:
+      with metrics.phase('compress', self.name) as phase:
+        phase['files'] += len(files)
+        for file, size, error, compressed in pool.imap_unordered(compress_file, [(file, compression, 1024 * 1024) for file in files]):
+          if error is not None and compressed:
+            self.log.warning("Compressed %s, but could not remove the original: %s" % (file, error))
+            kept += 1
+            saved += size
+          elif error is not None:
+            self.log.warning("Could not compress %s: %s" % (file, error))
+            failures += 1
+          else:
+            self.log.debug("Compressed %s, saved %s" % (file, convert_size(max(0, size))))
+            saved += size
+        phase['freed'] += max(0, saved)
+    finally:
+      pool.close()
+      pool.join()
+    if failures:
+      self.log.warning("%s: could not compress %s of %s files" % (self.name, failures, len(files)))
+    if kept:
+      self.log.warning("%s: %s files were compressed, but their originals are still there" % (self.name, kept))
+    # The compressed copies have new names, scan again next time
+    self.reset()
+
+    # Return saved space
+    return(max(0, saved))
 
   def auto_delete_files(self):
     self.config['autoconfirm'] = True
@@ -127,6 +1042,12 @@ class Files:
     # Return freed space
     return self.delete_files()
 
+def available_cpus():
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return multiprocessing.cpu_count()
+
 def convert_size(size):
   if size == 0:
       return "0B"
@@ -136,43 +1057,779 @@ def convert_size(size):
   s = round(size / p, 2)
   return "%s %s" % (s, size_name[i])
 
-def clean_system_journal(backup=True, vacuum_time="2", log=None):
+def disk_usage(path):
+  st = os.statvfs(path)
+  used = (st.f_blocks - st.f_bfree) * st.f_frsize
+  available = st.f_bavail * st.f_frsize
+  return used, available
+
+def usage_percent(used, available):
+  # Same percentage df shows: blocks reserved for root are left out
+  return 100.0 * used / max(1, used + available)
+
+def target_reached(used, available, target_free=None, target_usage=None):
+  if target_free is not None and available < target_free:
+    return False
+  if target_usage is not None and usage_percent(used, available) > target_usage:
+    return False
+  return True
+
+def reclaim_space(categories, path="/", target_free=None, target_usage=None, dry_run=False, report=None, log=None):
+  if dry_run and report is None:
+    report = DryRunReport()
+  used, available = disk_usage(path)
+  log.warning("Reclaiming space on %s: %s available, %.1f%% used" % (path, convert_size(available), usage_percent(used, available)))
+  if target_reached(used, available, target_free, target_usage):
+    log.warning("Target already reached, nothing to do")
+    return 0
+
+  # Least valuable categories first, then oldest, then largest files. A file
+  # matched by several categories is queued once, under the least valuable
+  # one, and the counter keeps ties from comparing categories
+  device = os.stat(path).st_dev
+  queued = {}
+  counter = itertools.count()
+  for category in categories:
+    for file in category.files:
+      st = category.stats[file]
+      if st.st_dev != device or stat.S_ISDIR(st.st_mode):
+        continue
+      if file in queued and queued[file][0] <= category.config['priority']:
+        continue
+      queued[file] = (category.config['priority'], st.st_mtime, -st.st_blocks, file, next(counter), category)
+  heap = list(queued.values())
+  heapq.heapify(heap)
+  log.info("%s candidates on %s" % (len(heap), path))
+
+  freed = 0
+  removed_files = 0
+  with metrics.phase('reclaim', path) as phase:
+    while heap and not target_reached(used, available, target_free, target_usage):
+      # Enough of the queue to cover what is missing, removed in one go per
+      # category before the filesystem is checked again
+      batch = {}
+      order = []
+      while heap and not target_reached(used, available, target_free, target_usage):
+        priority, mtime, blocks, file, n, category = heapq.heappop(heap)
+        if category not in batch:
+          batch[category] = []
+          order.append(category)
+        batch[category].append(file)
+        used += blocks * 512
+        available -= blocks * 512
+      if dry_run:
+        for category in order:
+          for file in batch[category]:
+            report.add(category, file, category.stats[file], category.matcher.match(os.path.basename(file)))
+            freed += category.stats[file].st_blocks * 512
+        continue
+      for category in order:
+        files = batch[category]
+        removed, failures, size = category.pool.delete(files, stats=dict((file, category.stats[file]) for file in files))
+        category.forget(removed)
+        freed += size
+        removed_files += len(removed)
+      used, available = disk_usage(path)
+    if not dry_run:
+      phase['freed'] += freed
+
+  if dry_run:
+    log.warning("Dry run: removing the files above would free about %s, leaving %s available (%.1f%% used)" % (convert_size(freed), convert_size(available), usage_percent(used, available)))
+  elif target_reached(used, available, target_free, target_usage):
+    log.warning("Target reached after removing %s files: %s available, %.1f%% used" % (removed_files, convert_size(available), usage_percent(used, available)))
+  else:
+    log.warning("Ran out of candidates before reaching the target: %s available, %.1f%% used" % (convert_size(available), usage_percent(used, available)))
+  return freed
+
+class Inotify:
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+
+  def __init__(self, paths, log=None):
+    self.log = log
+    self.fd = None
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+      fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0o2000000))
+      if fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+      self.log.info("inotify is not available, polling only: %s" % e)
+      return
+    self.fd = fd
+    mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+    for path in paths:
+      if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+        self.log.debug("Could not watch %s: %s" % (path, os.strerror(ctypes.get_errno())))
+
+  def wait(self, timeout):
+    if self.fd is None:
+      sleep(timeout)
+      return False
+    ready = select.select([self.fd], [], [], timeout)[0]
+    if not ready:
+      return False
+    # Only the wake-up matters, drain the queued events
+    try:
+      while os.read(self.fd, 65536):
+        pass
+    except OSError:
+      pass
+    return True
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+def acquire_lock(path, log=None):
+  lock = open(path, "a+")
+  try:
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    lock.seek(0)
+    log.warning("Another cleanup (pid %s) is already running, holding %s" % (lock.read().strip() or "?", path))
+    lock.close()
+    return None
+  lock.seek(0)
+  lock.truncate()
+  lock.write("%s\n" % os.getpid())
+  lock.flush()
+  return lock
+
+def run_daemon(categories, paths, high_watermark, low_watermark, interval=30, index=None, metrics_file=None, profile=False, log=None):
+  filesystems = {}
+  for path in paths:
+    try:
+      filesystems.setdefault(os.stat(path).st_dev, path)
+    except OSError:
+      log.debug("Not watching %s: does not exist" % path)
+  roots = []
+  for category in categories:
+    roots += [root for root in category.get_roots() if root not in roots]
+  watcher = Inotify(roots, log=log)
+  stopping = []
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+  log.warning("--- Starting Cleanup daemon: cleaning %s when usage goes over %s%% until it is under %s%% ---" % (", ".join(filesystems.values()), high_watermark, low_watermark))
+  # Filesystems that stayed over the watermark with nothing left to remove
+  exhausted = {}
+  try:
+    while not stopping:
+      for path in filesystems.values():
+        used, available = disk_usage(path)
+        if usage_percent(used, available) < high_watermark:
+          exhausted.pop(path, None)
+          continue
+        if time() - exhausted.get(path, 0) < interval * 10:
+          continue
+        log.warning("%s is %.1f%% used, over the %s%% high watermark" % (path, usage_percent(used, available), high_watermark))
+        # Files may have come and gone since the last cleanup
+        for category in categories:
+          category.reset()
+        metrics.reset()
+        reclaim_space(categories, path=path, target_usage=low_watermark, log=log)
+        if index is not None:
+          index.save()
+        if metrics_file:
+          metrics.write_prometheus(metrics_file, log=log)
+        used, available = disk_usage(path)
+        if usage_percent(used, available) >= high_watermark:
+          exhausted[path] = time()
+      watcher.wait(interval)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watcher.close()
+  if profile and metrics.order:
+    metrics.report()
+  log.warning("--- Stopping Cleanup daemon ---")
+
+def discover_tree(root, device, top, seen, recursive=True):
+  largest = []
+  directories = {}
+  stack = [root]
+  while stack:
+    directory = stack.pop()
+    size = 0
+    try:
+      names = os.listdir(directory)
+    except OSError:
+      continue
+    for name in names:
+      path = os.path.join(directory, name)
+      try:
+        st = os.lstat(path)
+      except OSError:
+        continue
+      if st.st_dev != device:
+        continue
+      if stat.S_ISDIR(st.st_mode):
+        if recursive:
+          stack.append(path)
+        continue
+      if st.st_nlink > 1:
+        if (st.st_dev, st.st_ino) in seen:
+          continue
+        seen.add((st.st_dev, st.st_ino))
+      blocks = st.st_blocks * 512
+      size += blocks
+      # Bounded min-heap: only the N largest files are ever kept in memory
+      if len(largest) < top:
+        heapq.heappush(largest, (blocks, path))
+      elif blocks > largest[0][0]:
+        heapq.heapreplace(largest, (blocks, path))
+    directories[directory] = size
+  return largest, directories
+
+def discover(paths, categories=[], top=20, workers=8, log=None):
+  jobs = []
+  devices = set()
+  roots = []
+  for path in paths:
+    try:
+      device = os.lstat(path).st_dev
+    except OSError:
+      log.debug("Not discovering %s: does not exist" % path)
+      continue
+    if device in devices:
+      continue
+    devices.add(device)
+    roots.append(path)
+    # One job per top-level directory, the files right under the root go in a job of their own
+    jobs.append((path, device, False))
+    for name in os.listdir(path):
+      child = os.path.join(path, name)
+      try:
+        if os.lstat(child).st_dev == device and os.path.isdir(child) and not os.path.islink(child):
+          jobs.append((child, device, True))
+      except OSError:
+        pass
+  log.warning("Discovering largest files in %s" % ", ".join(roots))
+
+  # Shared between workers so hard links spread over several jobs are counted once
+  seen = set()
+  def run(job):
+    path, device, recursive = job
+    return discover_tree(path, device, top, seen, recursive)
+
+  if ThreadPoolExecutor is not None and workers > 1:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(run, jobs))
+  else:
+    results = [run(job) for job in jobs]
+
+  largest = []
+  directories = {}
+  device_of = {}
+  for (path, device, recursive), (files, sizes) in zip(jobs, results):
+    largest += files
+    directories.update(sizes)
+    for directory in sizes:
+      device_of[directory] = device
+  largest = heapq.nlargest(top, largest)
+
+  # Roll sizes up so each directory includes everything below it on the same
+  # filesystem, e.g. /data is left out of /
+  totals = dict(directories)
+  for directory in sorted(directories, key=lambda d: d.count("/"), reverse=True):
+    parent = os.path.dirname(directory)
+    if parent != directory and parent in totals and device_of[parent] == device_of[directory]:
+      totals[parent] += totals[directory]
+
+  print("--- Largest files ---")
+  for size, path in largest:
+    labels = [category.name for category in categories if category.matches(path)]
+    print("%10s  %-30s %s" % (convert_size(size), ", ".join(labels) or "-", path))
+  print("--- Largest directories ---")
+  for path in sorted(totals, key=totals.get, reverse=True)[:top]:
+    print("%10s  %s" % (convert_size(totals[path]), path))
+  return largest, totals
+
+def file_digest(path, size=None, block_size=64*1024, chunk_size=1024*1024):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    if size is None:
+      while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+          break
+        digest.update(chunk)
+    else:
+      # Partial hash: only the first and last blocks
+      digest.update(f.read(block_size))
+      if size > block_size:
+        f.seek(max(block_size, size - block_size))
+        digest.update(f.read(block_size))
+  return digest.hexdigest()
+
+def group_by(files, key, log=None):
+  groups = {}
+  for entry in files:
+    try:
+      groups.setdefault(key(entry), []).append(entry)
+    except (IOError, OSError) as e:
+      log.warning("Could not read %s: %s" % (entry[0], e))
+  return [group for group in groups.values() if len(group) > 1]
+
+def find_duplicates(categories, log=None):
+  files = []
+  inodes = set()
+  for category in categories:
+    for file in category.files:
+      st = category.stats[file]
+      # Hard links to an inode already seen are not copies
+      if stat.S_ISREG(st.st_mode) and st.st_size > 0 and (st.st_dev, st.st_ino) not in inodes:
+        inodes.add((st.st_dev, st.st_ino))
+        files.append((file, st, category))
+  # Files with a size nobody else has are never read
+  duplicates = []
+  for group in group_by(files, lambda entry: entry[1].st_size, log=log):
+    size = group[0][1].st_size
+    for partial in group_by(group, lambda entry: file_digest(entry[0], size), log=log):
+      # Small files were read completely by the partial hash already
+      if size <= 2 * 64 * 1024:
+        duplicates.append(partial)
+        continue
+      duplicates += group_by(partial, lambda entry: file_digest(entry[0]), log=log)
+  return duplicates
+
+def deduplicate(categories, action="report", stream=None, log=None):
+  stream = stream or sys.stdout
+  freed = 0
+  wasted = 0
+  for group in find_duplicates(categories, log=log):
+    # Keep the oldest copy
+    group.sort(key=lambda entry: (entry[1].st_mtime, entry[0]))
+    keep, keep_st, keep_category = group[0]
+    wasted += sum(st.st_blocks * 512 for path, st, category in group[1:])
+    stream.write("%10s  %s\n" % (convert_size(keep_st.st_blocks * 512), keep))
+    for path, st, category in group[1:]:
+      stream.write("%10s  = %s\n" % ("", path))
+      if action == "delete":
+        removed, failures, size = category.pool.delete([path], stats={path: st})
+        category.forget(removed)
+        freed += size
+      elif action == "hardlink":
+        if st.st_dev != keep_st.st_dev:
+          log.warning("Not linking %s to %s: different filesystems" % (path, keep))
+          continue
+        tmp = os.path.join(os.path.dirname(path), ".%s.%s.tmp" % (os.path.basename(path), os.getpid()))
+        try:
+          os.link(keep, tmp)
+          os.rename(tmp, path)
+        except OSError as e:
+          log.warning("Could not replace %s with a link to %s: %s" % (path, keep, e))
+          try:
+            os.remove(tmp)
+          except OSError:
+            pass
+          continue
+        category.forget([path])
+        if st.st_nlink == 1:
+          freed += st.st_blocks * 512
+  log.warning("Duplicate files use %s" % convert_size(wasted))
+  return freed
+
+def parse_size(text):
+  units = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+  match = re.match(r'^\s*([0-9.]+)\s*([BKMGT]?)B?\s*$', str(text).upper())
+  if not match:
+    raise argparse.ArgumentTypeError("invalid size: %s" % text)
+  return int(float(match.group(1)) * units[match.group(2)])
+
+# Rough size of the compressed text export relative to the binary journal files
+JOURNAL_BACKUP_RATIO = 0.2
+
+def journal_files(journal_dir="/var/log/journal"):
+  files = []
+  for name, path, depth, is_dir in walk(journal_dir):
+    if not is_dir and (name.endswith(".journal") or name.endswith(".journal~")):
+      try:
+        files.append((path, os.lstat(path)))
+      except OSError:
+        pass
+  return files
+
+# Archived files are named <prefix>@<seqnum id>-<head seqnum>-<head realtime>.journal,
+# files put aside as corrupted <prefix>@<head realtime>-<random>.journal~
+JOURNAL_ARCHIVED = re.compile(r".*@[0-9a-f]{32}-([0-9a-f]{16})-([0-9a-f]{16})\.journal$")
+JOURNAL_DISPOSED = re.compile(r".*@([0-9a-f]{16})-[0-9a-f]{16}\.journal~$")
+
+# When the first entry of an archived journal file was written, lowered to the
+# file timestamps like journald does, with its head sequence number. None for
+# active files
+def journal_head(path, st):
+  name = os.path.basename(path)
+  match = JOURNAL_ARCHIVED.match(name)
+  if match is not None:
+    seqnum, realtime = int(match.group(1), 16), int(match.group(2), 16)
+  else:
+    match = JOURNAL_DISPOSED.match(name)
+    if match is None:
+      return None
+    seqnum, realtime = 0, int(match.group(1), 16)
+  return min(realtime / 1000000.0, st.st_mtime, st.st_atime), seqnum
+
+# Archived journal files that journalctl would vacuum with these limits, oldest
+# first. Like journald, each directory is handled on its own, files are ordered
+# and aged by the time of their first entry, active files are never removed but
+# count towards max_files, and max_size applies to the archived files
+def journal_vacuum_candidates(files, cutoff=None, max_size=None, max_files=None):
+  directories = {}
+  for path, st in files:
+    directories.setdefault(os.path.dirname(path), []).append((path, st))
+  candidates = []
+  for directory, entries in sorted(directories.items()):
+    archived = []
+    for path, st in entries:
+      head = journal_head(path, st)
+      if head is not None:
+        archived.append((head, path, st))
+    archived.sort(key=lambda file: file[0])
+    active = len(entries) - len(archived)
+    used = sum(st.st_blocks * 512 for head, path, st in archived)
+    for n, ((realtime, seqnum), path, st) in enumerate(archived):
+      if (cutoff is None or realtime >= cutoff) and (max_files is None or active + len(archived) - n <= max_files) and (max_size is None or used <= max_size):
+        break
+      candidates.append((path, st))
+      used -= st.st_blocks * 512
+  return candidates
+
+def compressed_writer(f, compression, name=""):
+  if compression == "zstd":
+    return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+  return gzip.GzipFile(filename=name, mode="wb", fileobj=f)
+
+# Backs up the entries of the journal files about to be vacuumed, see journal_vacuum_candidates
+def backup_system_journal(backup_file, candidates, compression="gzip", chunk_size=1024*1024, log=None):
+  if compression == "zstd" and zstandard is None:
+    log.warning("zstandard module is not available, compressing journal backup with gzip")
+    compression = "gzip"
+  backup_file += ".zst" if compression == "zstd" else ".gz"
+  if not candidates:
+    log.info("No archived journal files to vacuum, skipping backup")
+    return None
+  archived = [st for path, st in candidates]
+  # Up to the last entry of the newest file, which is its modification time
+  until = datetime.fromtimestamp(max(st.st_mtime for st in archived) + 1).strftime("%Y-%m-%d %H:%M:%S")
+  estimate = int(sum(st.st_blocks * 512 for st in archived) * JOURNAL_BACKUP_RATIO)
+  available = free_bytes(os.path.dirname(backup_file))
+  if available < estimate:
+    log.warning("Not backing up journal: %s needs about %s but only %s is free" % (os.path.dirname(backup_file), convert_size(estimate), convert_size(available)))
+    return None
+
+  log.info("Backing up system journal until %s to %s before cleanup (about %s)" % (until, backup_file, convert_size(estimate)))
+  process = subprocess.Popen(["journalctl", "--no-pager", "--until", until], stdout=subprocess.PIPE)
+  f = open(backup_file, "wb")
+  writer = compressed_writer(f, compression, os.path.basename(backup_file)[:-len(".gz")])
+  try:
+    try:
+      # Copy in fixed-size chunks so memory use doesn't depend on the journal size
+      while True:
+        chunk = process.stdout.read(chunk_size)
+        if not chunk:
+          break
+        writer.write(chunk)
+    finally:
+      writer.close()
+      f.close()
+      process.stdout.close()
+    if process.wait() != 0:
+      raise OSError("journalctl exited with status %s" % process.returncode)
+  except (IOError, OSError) as e:
+    if process.poll() is None:
+      process.kill()
+      process.wait()
+    try:
+      os.remove(backup_file)
+    except OSError:
+      pass
+    raise
+  log.info("Journal backup %s written (%s)" % (backup_file, convert_size(os.path.getsize(backup_file))))
+  return backup_file
+
+def clean_system_journal(backup=True, vacuum_time="2", vacuum_size=None, vacuum_files=None, compression="gzip", journal_dir="/var/log/journal", log=None):
   now=datetime.utcnow()
   now=datetime.isoformat(now)
   journal_backup_dir = "/data/cvpbackup"
   journal_backup_filename = "journalctl-" + now
   journal_backup_file = journal_backup_dir + "/" + journal_backup_filename
-  journal_backup_cmd = "/bin/bash -c \"journalctl > " + journal_backup_file + "\""
-  journal_cleanup_cmd = "/bin/bash -c \"journalctl --vacuum-time=" + str(vacuum_time) + "d\""
+
+  before = journal_files(journal_dir)
+  used = allocated_size(dict(before))
+  cutoff = time() - int(vacuum_time) * 86400 if vacuum_time is not None else None
+  candidates = journal_vacuum_candidates(before, cutoff=cutoff, max_size=vacuum_size, max_files=vacuum_files)
+  # Nothing to vacuum, don't even start journalctl
+  if not candidates:
+    log.info("System journal uses %s in %s files, within limits, skipping vacuum" % (convert_size(used), len(before)))
+    return 0
   log.warning("Cleaning system journal")
 
   if backup:
-    log.info("Backing up current system journal to %s before cleanup" % (journal_backup_file))
+    with metrics.phase('journal-backup'):
+      try:
+        backup_system_journal(journal_backup_file, candidates, compression=compression, log=log)
+      except Exception as e:
+        log.warning("Could not back up journal: %s" % e)
+
+  command = ["journalctl"]
+  if vacuum_time is not None:
+    command.append("--vacuum-time=%sd" % int(vacuum_time))
+  if vacuum_size is not None:
+    command.append("--vacuum-size=%s" % vacuum_size)
+  if vacuum_files is not None:
+    command.append("--vacuum-files=%s" % vacuum_files)
+  with metrics.phase('journal-vacuum') as phase:
+    output = subprocess.check_output(command, stderr=subprocess.STDOUT).decode()
+    log.debug("journalctl output: %s" % output.strip())
+    # Measure what the vacuum freed rather than trusting its output
+    freed = max(0, used - allocated_size(dict(journal_files(journal_dir))))
+    phase['freed'] += freed
+
+  # Return freed space
+  return(freed)
+
+def report_metrics(args, log=None):
+  if args.metrics_file:
+    metrics.write_prometheus(args.metrics_file, log=log)
+  if args.profile:
+    metrics.report()
+
+CVP_LOG_DIRECTORIES = ["/cvpi/logs", "/cvpi/hadoop/logs", "/cvpi/hbase/logs", "/cvpi/apps/turbine/logs", "/cvpi/apps/aeris/logs", "/cvpi/apps/cvp/logs"]
+
+# Built-in categories. A --categories file can change them, disable them with
+# "enabled": false, or add new ones. Categories sharing a flag and giving a
+# choice are offered as a submenu, e.g. --clean-kubelet-logs {all,info,...}
+CATEGORIES = [
+  {'id': 'system-logs', 'name': "System logs", 'directories': ["/var/log"], 'patterns': ["*.gz", "*.[0-9]"], 'priority': 60, 'compress': True,
+   'help': "Clean system log files", 'menu': "0", 'label': "Clean old system logs", 'show': "Show old system log files"},
+  {'id': 'system-crash', 'name': "System crash files", 'directories': ["/var/crash"], 'priority': 40,
+   'help': "Clean system crash log files", 'menu': "1", 'label': "Clean system crash files", 'show': "Show old system crash files"},
+  {'id': 'cvp-logs', 'name': "CVP Rotated logs", 'directories': CVP_LOG_DIRECTORIES, 'patterns': ["*.log.*", "*.out.*", "*.gc.*", "*.gz", "*.[0-9]"], 'priority': 70, 'compress': True,
+   'help': "Clean rotated CVP log files", 'menu': "2", 'label': "Clean Rotated CVP logs", 'show': "Show Rotated CVP log files"},
+  {'id': 'current-logs', 'name': "CVP Current logs", 'directories': CVP_LOG_DIRECTORIES, 'patterns': ["*.log", "*.out", "*.gc"], 'priority': 90, 'in_use': True, 'clean_all': False, 'reclaimable': False,
+   'help': "Clean current CVP log files", 'menu': "3", 'label': "Clean Current CVP logs", 'show': "Show Current CVP log files"},
+  {'id': 'cvp-images', 'name': "CVP docker images", 'directories': ["/cvpi/docker"], 'patterns': ["*.gz"], 'priority': 20, 'dedupe': True,
+   'help': "Clean CVP docker images", 'menu': "4", 'label': "Clean CVP docker images", 'show': "Show CVP docker images"},
+  {'id': 'cvp-rpms', 'name': "CVP RPMs", 'directories': ["/RPMS"], 'patterns': ["*.rpm"], 'priority': 20, 'dedupe': True,
+   'help': "Clean CVP RPMs", 'menu': "5", 'label': "Clean CVP RPMs", 'show': "Show CVP RPM files"},
+  {'id': 'cvp-esdumps', 'name': "CVP Elasticsearch Heap Dumps", 'directories': ["/cvpi/apps/aeris/elasticsearch"], 'patterns': ["*.hprof"], 'priority': 30, 'dedupe': True,
+   'help': "Clean CVP's Elasticsearch Heap Dumps", 'menu': "6", 'label': "Clean Elasticsearch Heap Dumps", 'show': "Show Elasticsearch heap dumps files"},
+  {'id': 'cvp-tmpupgrade', 'name': "Temporary upgrade files", 'directories': ["/tmp/upgrade*"], 'remove_directories': True, 'priority': 10,
+   'help': "Clean CVP temporary upgrade files", 'menu': "7", 'label': "Clean CVP temporary upgrade directories", 'show': "Show temporary upgrade files"},
+  {'id': 'kubelet-logs', 'name': "Kubelet Logs - All", 'directories': ["/var/log"], 'patterns': ["kubelet.*.root.log.*"], 'priority': 50, 'choice': "all",
+   'help': "Clean Kubelet log files", 'menu': "9", 'group': "Clean kubelet logs", 'label': "Clean all kubelet logs", 'show': "Show Kubelet logs"},
+  {'id': 'kubelet-logs-info', 'name': "Kubelet Logs - Info", 'directories': ["/var/log"], 'patterns': ["kubelet.*.root.log.INFO.*"], 'priority': 50, 'flag': "clean-kubelet-logs", 'choice': "info", 'clean_all': False, 'reclaimable': False,
+   'label': "Clean kubelet info logs"},
+  {'id': 'kubelet-logs-warning', 'name': "Kubelet Logs - Warning", 'directories': ["/var/log"], 'patterns': ["kubelet.*.root.log.WARNING.*"], 'priority': 50, 'flag': "clean-kubelet-logs", 'choice': "warning", 'clean_all': False, 'reclaimable': False,
+   'label': "Clean kubelet warning logs"},
+  {'id': 'kubelet-logs-error', 'name': "Kubelet Logs - Error", 'directories': ["/var/log"], 'patterns': ["kubelet.*.root.log.ERROR.*"], 'priority': 50, 'flag': "clean-kubelet-logs", 'choice': "error", 'clean_all': False, 'reclaimable': False,
+   'label': "Clean kubelet error logs"},
+  {'id': 'cvp-zkdumps', 'name': "CVP Zookeeper Heap Dumps", 'directories': ["/home/cvp"], 'patterns': ["*.hprof"], 'priority': 30, 'dedupe': True,
+   'help': "Clean CVP's Zookeeper Heap Dumps", 'menu': "10", 'label': "Clean Zookeeper Heap Dumps", 'show': "Show Zookeeper heap dump files"},
+]
+
+CATEGORY_DEFAULTS = {
+  'patterns': ["*"],
+  'recursive': True,
+  'remove_directories': False,
+  'priority': 50,
+  'retention': {},
+  'flag': None,
+  'choice': None,
+  'help': None,
+  'menu': None,
+  'group': None,
+  'label': None,
+  'show': None,
+  'clean_all': True,
+  'reclaimable': True,
+  'dedupe': False,
+  'compress': False,
+  'in_use': False,
+}
+
+# Menu entry of the system journal, which isn't a category of files
+JOURNAL_MENU = "8"
+
+class CategoryRegistry:
+  def __init__(self, entries=CATEGORIES):
+    self.entries = []
+    self.files = {}
+    self.update(entries)
+
+  def load(self, path):
+    is_yaml = path.endswith((".yaml", ".yml"))
+    if is_yaml and yaml is None:
+      raise ValueError("the PyYAML module is needed to read %s" % path)
     try:
-      os.system(journal_backup_cmd)
+      with open(path) as f:
+        data = yaml.safe_load(f) if is_yaml else json.load(f)
+    except (IOError, OSError) as e:
+      raise ValueError("could not read %s: %s" % (path, e))
     except Exception as e:
-      log.warning("Could not back up journal: %s" % e)
-  
-  output = subprocess.check_output(journal_cleanup_cmd, stderr=subprocess.STDOUT, shell=True).decode()
-
-  size_diff = re.search('freed (.+) of archived journals', output).groups()[0]
-  if 'B' in size_diff:
-    size_diff = float(size_diff.split('B')[0])
-  elif 'K' in size_diff:
-    size_diff = float(size_diff.split('K')[0])
-    size_diff = size_diff * 1024
-  elif 'M' in size_diff:
-    size_diff = float(size_diff.split('M')[0])
-    size_diff = size_diff * 1024 * 1024
-  elif 'G' in size_diff:
-    size_diff = float(size_diff.split('G')[0])
-    size_diff = size_diff * 1024 * 1024 * 1024
-  else:
-    log.warning("Could not parse size unit. Freed space will be inacurate.")
-    size_diff = 0
+      raise ValueError("could not parse %s: %s" % (path, e))
+    if isinstance(data, dict):
+      data = data.get('categories')
+    if not isinstance(data, list):
+      raise ValueError("%s should hold a list of categories" % path)
+    self.update(data)
 
-  # Return freed space
-  return(int(size_diff))
+  def update(self, entries):
+    for entry in entries:
+      if not isinstance(entry, dict) or not re.match(r'^[a-z0-9][a-z0-9-]*$', str(entry.get('id', ""))):
+        raise ValueError("every category needs an id made of lowercase letters, digits and dashes: %s" % entry)
+      unknown = set(entry) - set(CATEGORY_DEFAULTS) - set(['id', 'name', 'directories', 'enabled'])
+      if unknown:
+        raise ValueError("category %s: unknown keys %s" % (entry['id'], ", ".join(sorted(unknown))))
+      current = self.entry(entry['id'])
+      if entry.get('enabled', True) is False:
+        if current is not None:
+          self.entries.remove(current)
+        continue
+      if current is None:
+        if not entry.get('name') or not entry.get('directories'):
+          raise ValueError("category %s needs a name and directories" % entry['id'])
+        current = dict(CATEGORY_DEFAULTS)
+        self.entries.append(current)
+      current.update((key, value) for key, value in entry.items() if key != 'enabled')
+      self.__validate(current)
+    self.groups()
+
+  def __validate(self, entry):
+    for key in ('directories', 'patterns'):
+      if not isinstance(entry[key], list) or not entry[key]:
+        raise ValueError("category %s: %s should be a non-empty list" % (entry['id'], key))
+    if not isinstance(entry['priority'], int):
+      raise ValueError("category %s: priority should be an integer" % entry['id'])
+    retention = dict(entry['retention'] or {})
+    unknown = set(retention) - set(['keep_newest', 'keep_days', 'keep_size'])
+    if unknown:
+      raise ValueError("category %s: unknown retention rules %s" % (entry['id'], ", ".join(sorted(unknown))))
+    if 'keep_size' in retention:
+      try:
+        retention['keep_size'] = parse_size(retention['keep_size'])
+      except argparse.ArgumentTypeError as e:
+        raise ValueError("category %s: %s" % (entry['id'], e))
+    entry['retention'] = retention
+    entry['flag'] = entry['flag'] or "clean-" + entry['id']
+    entry['help'] = entry['help'] or "Clean " + entry['name']
+    entry['label'] = entry['label'] or "Clean " + entry['name']
+    entry['show'] = entry['show'] or "Show " + entry['name']
+
+  def entry(self, id):
+    for entry in self.entries:
+      if entry['id'] == id:
+        return entry
+    return None
+
+  # Entries sharing a command line flag, in registry order
+  def groups(self):
+    groups = []
+    flags = {}
+    for entry in self.entries:
+      if entry['flag'] not in flags:
+        flags[entry['flag']] = []
+        groups.append((entry['flag'], flags[entry['flag']]))
+      flags[entry['flag']].append(entry)
+    for flag, entries in groups:
+      if len(entries) > 1 and any(entry['choice'] is None for entry in entries):
+        raise ValueError("categories %s share --%s, so each needs a choice" % (", ".join(entry['id'] for entry in entries), flag))
+    return groups
+
+  def add_arguments(self, parser):
+    group = parser.add_argument_group("categories", "Remove the files of one or more categories, see --categories to change them")
+    for flag, entries in self.groups():
+      if entries[0]['choice'] is None:
+        group.add_argument("--" + flag, action="store_true", default=False, help=entries[0]['help'])
+      else:
+        group.add_argument("--" + flag, choices=[entry['choice'] for entry in entries], default=None, help=entries[0]['help'])
+
+  def build(self, retention={}, log=None, index=None, pool=None):
+    # A single index makes categories rooted in the same directory share one scan
+    index = index if index is not None else DirectoryIndex(log=log)
+    for entry in self.entries:
+      rules = dict(entry['retention'])
+      rules.update(retention)
+      self.files[entry['id']] = Files(name=entry['name'], directories=entry['directories'], prefixes=entry['patterns'], recursive=entry['recursive'], remove_directories=entry['remove_directories'], priority=entry['priority'], retention=rules, log=log, index=index, pool=pool)
+    return self.categories()
+
+  def get(self, id):
+    return self.files[id]
+
+  def categories(self, key=None):
+    return [self.files[entry['id']] for entry in self.entries if key is None or entry[key]]
+
+  def selected(self, args):
+    selected = []
+    for flag, entries in self.groups():
+      value = getattr(args, flag.replace("-", "_"))
+      for entry in entries:
+        chosen = value == entry['choice'] if entry['choice'] is not None else value
+        if chosen or (args.clean_all and entry['clean_all']):
+          selected.append(self.files[entry['id']])
+          # One choice per flag, e.g. all kubelet logs already include the info ones
+          break
+    return selected
+
+  # Menu entries, numbered after the built-in ones when they don't say
+  def menu_groups(self):
+    groups = self.groups()
+    used = [int(entries[0]['menu']) for flag, entries in groups if str(entries[0]['menu']).isdigit()] + [int(JOURNAL_MENU)]
+    number = max(used) + 1
+    menus = []
+    for flag, entries in groups:
+      key = entries[0]['menu']
+      if key is None:
+        key = str(number)
+        number += 1
+      menus.append((str(key), entries))
+    return menus
+
+# Scans categories one at a time in a background thread, so the interactive
+# menu shows up right away and fills in sizes as they become known
+class BackgroundScanner:
+  def __init__(self, log=None):
+    self.log = log
+    self.queue = Queue()
+    self.queued = {}
+    self.version = 0
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self.__run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def scan(self, category):
+    with self.lock:
+      self.queued[category] = self.queued.get(category, 0) + 1
+    self.queue.put(category)
+
+  def refresh(self, category):
+    category.reset()
+    self.scan(category)
+
+  def busy(self, category=None):
+    with self.lock:
+      if category is None:
+        return any(self.queued.values())
+      return self.queued.get(category, 0) > 0
+
+  def pretty_size(self, category):
+    if self.busy(category) and not category.scanned():
+      return "scanning..."
+    return category.pretty_size
+
+  def __run(self):
+    while True:
+      category = self.queue.get()
+      try:
+        category.files
+      except Exception as e:
+        self.log.warning("Could not scan %s: %s" % (category.name, e))
+      with self.lock:
+        self.queued[category] -= 1
+        self.version += 1
 
 def showMenu(items, sort=True):
   options = list(items.keys())
@@ -183,32 +1840,114 @@ def showMenu(items, sort=True):
   choice = input("Choose an option\n")
   return(choice)
 
-def check_args():
+# Like showMenu, but draws the menu again whenever a background scan finishes
+def showLiveMenu(build, scanner, sort=True):
+  while True:
+    version = scanner.version
+    os.system('clear')
+    items = build()
+    options = list(items.keys())
+    if sort:
+      options.sort()
+    for entry in options:
+      print(entry + " - " + items[entry])
+    if not scanner.busy():
+      return(input("Choose an option\n"))
+    print("Choose an option")
+    sys.stdout.flush()
+    while scanner.version == version:
+      if select.select([sys.stdin], [], [], 0.5)[0]:
+        choice = sys.stdin.readline()
+        if not choice:
+          raise EOFError()
+        return(choice.rstrip("\n"))
+
+def check_args(registry):
     #Create parser and add arguments
     parser = argparse.ArgumentParser(description="Clean CVP and system logs and unecessary files.", epilog="You can run the script interactively by not using any arguments.")
 
     default_vacuum_time=2
     default_logfile='/var/log/cleanup.log'
+    default_gentle_rate='50M'
+    default_compress_nice=19
+    default_target_path='/'
+    default_high_watermark=85
+    default_low_watermark=75
+    default_poll_interval=30
+    default_watch_paths=['/', '/data']
+    default_discover_top=20
+    default_discover_workers=8
+    default_lock_file='/var/run/cvp-cleanup.lock'
+    default_scan_cache='/var/lib/cvp-cleanup/scan-cache.json'
+    default_categories='/etc/cvp-cleanup/categories.json'
+
+    # Categories, and so their flags, can come from a file
+    preparser = argparse.ArgumentParser(add_help=False)
+    preparser.add_argument("--categories", default=None)
+    categories = preparser.parse_known_args()[0].categories
+    if categories is None and os.path.exists(default_categories):
+      categories = default_categories
+    if categories is not None:
+      try:
+        registry.load(categories)
+      except ValueError as e:
+        parser.error("--categories: %s" % e)
 
     parser.add_argument("--clean-all", action="store_true", default=False, help="Clean all files except for current CVP logs")
-    parser.add_argument("--clean-current-logs", action="store_true", default=False, help="Clean current CVP log files")
-    parser.add_argument("--clean-cvp-esdumps", action="store_true", default=False, help="Clean CVP's Elasticsearch Heap Dumps")
-    parser.add_argument("--clean-cvp-zkdumps", action="store_true", default=False, help="Clean CVP's Zookeeper Heap Dumps")
-    parser.add_argument("--clean-cvp-images", action="store_true", default=False, help="Clean CVP docker images")
-    parser.add_argument("--clean-cvp-logs", action="store_true", default=False, help="Clean rotated CVP log files")
-    parser.add_argument("--clean-cvp-rpms", action="store_true", default=False, help="Clean CVP RPMs")
-    parser.add_argument("--clean-cvp-tmpupgrade", action="store_true", default=False, help="Clean CVP temporary upgrade files")
-    parser.add_argument("--clean-kubelet-logs", choices=['all', 'info', 'warning', 'error'], default=None, help="Clean Kubelet log files")
-    parser.add_argument("--clean-system-crash", action="store_true", default=False, help="Clean system crash log files")
+    parser.add_argument("--reclaim-open-files", action="store_true", default=False, help="Free the space of deleted CVP log files that are still held open, without restarting CVP")
     parser.add_argument("--clean-system-journal", action="store_true", default=False, help="Vacuum system journal")
-    parser.add_argument("--clean-system-logs", action="store_true", default=False, help="Clean system log files")
+    parser.add_argument("--categories", default=None, type=str, help="JSON or YAML file changing the built-in categories or adding new ones. YAML needs the PyYAML module. Default: %s, if it exists" %default_categories)
+    parser.add_argument("--compress", action="store_true", default=False, help="Compress uncompressed rotated system and CVP logs in place instead of removing them")
+    parser.add_argument("--compress-format", choices=['gzip', 'zstd'], default='gzip', help="Compression used by --compress. zstd needs the zstandard module. Default: gzip")
+    parser.add_argument("--compress-workers", default=None, type=int, help="Number of processes compressing logs in parallel. Default: number of available CPUs")
+    parser.add_argument("--compress-nice", default=default_compress_nice, type=int, help="Niceness of the compressing processes. Default: %s" %default_compress_nice)
+    parser.add_argument("--keep-newest", default=None, type=int, help="Keep the newest N files of every category")
+    parser.add_argument("--keep-days", default=None, type=float, help="Keep files of every category modified in the last N days")
+    parser.add_argument("--keep-size", default=None, type=parse_size, help="Keep the newest files of every category up to this total size, e.g. 5G")
+    parser.add_argument("--target-free", default=None, type=parse_size, help="Remove just enough files (oldest and least useful first) to have this much space available, e.g. 20G")
+    parser.add_argument("--target-usage", default=None, type=float, help="Remove just enough files (oldest and least useful first) to bring disk usage down to this percentage")
+    parser.add_argument("--target-path", default=default_target_path, type=str, help="Filesystem checked by --target-free and --target-usage. Default: %s" %default_target_path)
+    parser.add_argument("--dry-run", action="store_true", default=False, help="Print the files that would be removed, and the totals per category, without removing anything")
+    parser.add_argument("--format", choices=['text', 'json', 'ndjson'], default='text', help="Output format of --dry-run. With json or ndjson, log messages go to stderr. Default: text")
+    parser.add_argument("--daemon", action="store_true", default=False, help="Keep running and clean up, oldest and least useful files first, whenever disk usage goes over --high-watermark")
+    parser.add_argument("--high-watermark", default=default_high_watermark, type=float, help="Disk usage percentage that starts a cleanup in daemon mode. Default: %s" %default_high_watermark)
+    parser.add_argument("--low-watermark", default=default_low_watermark, type=float, help="Disk usage percentage a cleanup in daemon mode brings usage down to. Default: %s" %default_low_watermark)
+    parser.add_argument("--poll-interval", default=default_poll_interval, type=float, help="Seconds between disk usage checks in daemon mode. Default: %s" %default_poll_interval)
+    parser.add_argument("--watch-path", action="append", default=None, help="Filesystem watched in daemon mode, can be repeated. Default: %s" %", ".join(default_watch_paths))
+    parser.add_argument("--lock-file", default=default_lock_file, type=str, help="Lock file preventing two cleanups from running at the same time. Default: %s" %default_lock_file)
+    parser.add_argument("--dedupe", choices=['report', 'delete', 'hardlink'], default=None, help="Find identical CVP docker images, RPMs and heap dumps, and report them, delete the extra copies or replace them with hard links")
+    parser.add_argument("--discover", nargs="?", const=default_discover_top, default=None, type=int, help="Only list the N largest files and directories (default N: %s) and the category they belong to, without removing anything" %default_discover_top)
+    parser.add_argument("--discover-path", action="append", default=None, help="Filesystem searched by --discover, can be repeated. Default: %s" %", ".join(default_watch_paths))
+    parser.add_argument("--discover-workers", default=default_discover_workers, type=int, help="Number of threads searching in parallel for --discover. Default: %s" %default_discover_workers)
+    parser.add_argument("--scan-cache", nargs="?", const=default_scan_cache, default=None, type=str, help="Reuse directory listings from previous runs for directories that did not change. Optionally takes the cache file path. Default: %s" %default_scan_cache)
+    parser.add_argument("--delete-workers", default=1, type=int, help="Number of threads used to remove files and directories in parallel. Default: 1")
+    parser.add_argument("--gentle-threshold", default=None, type=parse_size, help="Shrink files of at least this size (e.g. 1G) step by step before removing them, to avoid I/O bursts")
+    parser.add_argument("--gentle-rate", default=default_gentle_rate, type=parse_size, help="Bytes per second released when shrinking large files, 0 for no limit. Default: %s" %default_gentle_rate)
+    parser.add_argument("--idle-io", action="store_true", default=False, help="Use idle I/O priority while shrinking large files")
+    parser.add_argument("--journal-compression", choices=['gzip', 'zstd'], default='gzip', help="Compression used for the system journal backup. zstd needs the zstandard module. Default: gzip")
+    parser.add_argument("--metrics-file", default=None, type=str, help="Write per-phase timings, visited files, filesystem calls and freed bytes to this file in Prometheus text format, e.g. for the node_exporter textfile collector")
+    parser.add_argument("--profile", action="store_true", default=False, help="Print how long each phase took, per category, at the end of the run")
     parser.add_argument("--logfile", default=default_logfile, type=str, help="File to save logs to. Default: %s" %default_logfile)
     parser.add_argument("--vacuum-time", default=default_vacuum_time, type=int, help="How many days of logs to keep when vacuuming the system journal. Default: %s." %default_vacuum_time)
+    parser.add_argument("--vacuum-size", default=None, type=parse_size, help="Also vacuum the oldest archived journal files until the journal uses at most this much space, e.g. 500M")
+    parser.add_argument("--vacuum-files", default=None, type=int, help="Also vacuum the oldest archived journal files until at most this many are left")
     parser.add_argument("--verbose", '-v', action="store_true", default=False, help="Print additional messages to the console")
     parser.add_argument("--debug", action="store_true", default=False, help="Turn on debugging")
     parser.add_argument("--quiet","-q", action="store_true", default=False, help="Turns off output to terminal")
+    try:
+      registry.add_arguments(parser)
+    except argparse.ArgumentError as e:
+      parser.error("--categories: %s" % e)
 
     args = parser.parse_args()
+    if args.watch_path is None:
+      args.watch_path = default_watch_paths
+    if args.discover_path is None:
+      args.discover_path = default_watch_paths
+    if args.daemon and args.low_watermark >= args.high_watermark:
+      parser.error("--low-watermark must be lower than --high-watermark")
+    if args.daemon and args.dry_run:
+      parser.error("--dry-run can't be used with --daemon")
     return args
 
 def main():
@@ -222,14 +1961,16 @@ def main():
         sys.argv[1] = "--vacuum-time=%s" %sys.argv[1]
         sys.argv.append("--clean-all")    
 
-  args=check_args()
+  registry = CategoryRegistry()
+  args=check_args(registry)
 
   freed = 0
   with open(args.logfile, "a") as logf:
     log = logging.getLogger('cleanup')
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
-    stdout = logging.StreamHandler(sys.stdout)
+    # Keep stdout clean for machine-readable output
+    stdout = logging.StreamHandler(sys.stdout if args.format == 'text' else sys.stderr)
     if args.verbose:
       stdout.setLevel(logging.INFO)
     elif args.debug:
@@ -247,258 +1988,221 @@ def main():
 
     log.setLevel(logging.DEBUG)
 
-    system_logs = Files(name="System logs", directories=["/var/log"],prefixes=["*.gz", "*.[0-9]"], log=log)
-    system_crash_files = Files(name="System crash files", directories=["/var/crash"], log=log)
-    cvp_logs = Files(name="CVP Rotated logs", directories=["/cvpi/logs", "/cvpi/hadoop/logs", "/cvpi/hbase/logs", "/cvpi/apps/turbine/logs", "/cvpi/apps/aeris/logs", "/cvpi/apps/cvp/logs"], prefixes=["*.log.*", "*.out.*", "*.gc.*", "*.gz", "*.[0-9]"], log=log)
-    cvp_current_logs = Files(name="CVP Current logs", directories=["/cvpi/logs", "/cvpi/hadoop/logs", "/cvpi/hbase/logs", "/cvpi/apps/turbine/logs", "/cvpi/apps/aeris/logs", "/cvpi/apps/cvp/logs"], prefixes=["*.log", "*.out", "*.gc"], log=log)
-    cvp_docker_images = Files(name="CVP docker images", directories=["/cvpi/docker"], prefixes=["*.gz"], log=log)
-    cvp_rpms = Files(name="CVP RPMs", directories=["/RPMS"], prefixes=["*.rpm"], log=log)
-    cvp_elasticsearch_heap_dumps = Files(name="CVP Elasticsearch Heap Dumps", directories=["/cvpi/apps/aeris/elasticsearch"], prefixes=["*.hprof"], log=log)
-    cvp_tmp_upgrade = Files(name="Temporary upgrade files", directories=["/tmp/upgrade*"], prefixes=["*"], remove_directories=True, log=log)
-    cvp_clickhouse_zk_heap_dump = Files(name="CVP Zookeeper Heap Dumps", directories=["/home/cvp"], prefixes=["*.hprof"], log=log)
-
-    kubelet_logs = {}
-    kubelet_logs['all'] = Files(name="Kubelet Logs - All", directories=["/var/log"], prefixes=["kubelet.*.root.log.*"], log=log)
-    kubelet_logs['info'] = Files(name="Kubelet Logs - Info", directories=["/var/log"], prefixes=["kubelet.*.root.log.INFO.*"], log=log)
-    kubelet_logs['warning'] = Files(name="Kubelet Logs - Warning", directories=["/var/log"], prefixes=["kubelet.*.root.log.WARNING.*"], log=log)
-    kubelet_logs['error'] = Files(name="Kubelet Logs - Error", directories=["/var/log"], prefixes=["kubelet.*.root.log.ERROR.*"], log=log)
+    retention = {}
+    if args.keep_newest:
+      retention['keep_newest'] = args.keep_newest
+    if args.keep_days:
+      retention['keep_days'] = args.keep_days
+    if args.keep_size:
+      retention['keep_size'] = args.keep_size
+
+    # Categories scan on first use and share one walk per root directory
+    cache = None
+    if args.scan_cache:
+      cache = ScanCache(args.scan_cache, log=log)
+    index = DirectoryIndex(log=log, cache=cache)
+    open_files = OpenFileIndex(log=log)
+    pool = DeletionPool(workers=args.delete_workers, gentle_threshold=args.gentle_threshold, gentle_rate=args.gentle_rate, idle_io=args.idle_io, log=log)
+
+    registry.build(retention, log=log, index=index, pool=pool)
+    # Categories with files still being written to, removed only on request
+    in_use = registry.categories('in_use')
+    # Candidates for --target-free/--target-usage, see the priorities of CATEGORIES
+    reclaimable = [category for category in registry.categories('reclaimable') if category not in in_use]
+    compressible = registry.categories('compress')
 
     if len(sys.argv) > 1:
       log.warning("--- Starting Cleanup in Automatic mode ---")
       log.debug("Cleanup arguments: %s" %args)
-      if args.clean_current_logs:
+      if args.discover:
+        discover(args.discover_path, categories=reclaimable + in_use, top=args.discover, workers=args.discover_workers, log=log)
+        return
+      lock = acquire_lock(args.lock_file, log=log)
+      if lock is None:
+        return
+      if args.dedupe:
+        # A dry run only reports duplicates, away from the report on stdout unless it's text
+        action = 'report' if args.dry_run else args.dedupe
+        step = deduplicate(registry.categories('dedupe'), action=action, stream=sys.stdout if args.format == 'text' else sys.stderr, log=log)
+        freed += step
+        log.info("%s: freed %s" %('Duplicate files', convert_size(step)))
+      if args.daemon:
+        run_daemon(reclaimable, args.watch_path, args.high_watermark, args.low_watermark, interval=args.poll_interval, index=index, metrics_file=args.metrics_file, profile=args.profile, log=log)
+        return
+      report = DryRunReport(format=args.format) if args.dry_run else None
+      if args.target_free is not None or args.target_usage is not None:
+        step = reclaim_space(reclaimable, path=args.target_path, target_free=args.target_free, target_usage=args.target_usage, dry_run=args.dry_run, report=report, log=log)
+        if not args.dry_run:
+          freed += step
+
+      selected = registry.selected(args)
+      current = [category for category in selected if category in in_use]
+      selected = [category for category in selected if category not in in_use]
+
+      if args.dry_run:
+        for category in selected + current:
+          report.add_files(category)
+        report.close()
+        index.save()
+        report_metrics(args, log=log)
+        log.warning("--- Ending Cleanup --- Dry run, nothing removed")
+        return
+
+      if current:
         wait_time=12
         print("WARNING! This may remove files that may be useful to debug issues.")
         print("Press ctrl+c within %s seconds to abort" %(wait_time-2))
         sleep(wait_time)
-      if args.clean_system_logs or args.clean_all:
-        step = system_logs.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(system_logs.name, convert_size(step)))
-      if args.clean_system_crash or args.clean_all:
-        step = system_crash_files.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(system_crash_files.name, convert_size(step)))
-      if args.clean_cvp_logs or args.clean_all:
-        step = cvp_logs.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_logs.name, convert_size(step)))
-      if args.clean_cvp_images or args.clean_all:      
-        step = cvp_docker_images.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_docker_images.name, convert_size(step)))
-      if args.clean_cvp_rpms or args.clean_all:
-        step = cvp_rpms.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_rpms.name, convert_size(step)))
-      if args.clean_cvp_esdumps or args.clean_all:
-        step = cvp_elasticsearch_heap_dumps.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_elasticsearch_heap_dumps.name, convert_size(step)))
-      if args.clean_cvp_zkdumps or args.clean_all:
-        step = cvp_clickhouse_zk_heap_dump.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_clickhouse_zk_heap_dump.name, convert_size(step)))
-      if args.clean_cvp_tmpupgrade or args.clean_all:
-        step = cvp_tmp_upgrade.auto_delete_files()
-        freed += step
-        log.info("%s: freed %s" %(cvp_tmp_upgrade.name, convert_size(step)))
-      if args.clean_kubelet_logs == 'all' or args.clean_all:
-        step = kubelet_logs['all'].auto_delete_files()
-        freed += step
-        log.info("%s(all): freed %s" %(kubelet_logs['all'].name, convert_size(step)))
-      elif args.clean_kubelet_logs:
-        step = kubelet_logs[args.clean_kubelet_logs].auto_delete_files()
+      for category in selected:
+        if args.compress and category in compressible:
+          step = category.compress_files(workers=args.compress_workers, niceness=args.compress_nice, compression=args.compress_format)
+          log.info("%s: compressed, freed %s" %(category.name, convert_size(step)))
+        else:
+          step = category.auto_delete_files()
+          log.info("%s: freed %s" %(category.name, convert_size(step)))
         freed += step
-        log.info("%s(%s): freed %s" %(kubelet_logs[args.clean_kubelet_logs].name, args.clean_kubelet_logs, convert_size(step)))
       if args.clean_system_journal or args.clean_all:
-        step = clean_system_journal(vacuum_time=args.vacuum_time, log=log)
+        step = clean_system_journal(vacuum_time=args.vacuum_time, vacuum_size=args.vacuum_size, vacuum_files=args.vacuum_files, compression=args.journal_compression, log=log)
         freed += step
         log.info("%s: freed %s" %('Vacuum system journal', convert_size(step)))
-      if args.clean_current_logs:
-        step = cvp_current_logs.auto_delete_files()
+      for category in current:
+        step = category.auto_delete_files()
         freed += step
-        log.info("%s: freed %s" %(cvp_current_logs.name, convert_size(step)))
-        log.warning("Please restart CVP to free up space used by open log files.")
+        log.info("%s: freed %s" %(category.name, convert_size(step)))
+        reclaimed, failed = open_files.reclaim(category.get_roots())
+        log.info("%s: reclaimed %s from deleted files still open" %(category.name, convert_size(reclaimed)))
+        if failed:
+          log.warning("Please restart CVP to free up space used by open log files.")
+      if args.reclaim_open_files and not current:
+        for category in in_use:
+          step, failed = open_files.reclaim(category.get_roots())
+          freed += step
+          log.info("%s: reclaimed %s from deleted files still open" %(category.name, convert_size(step)))
+      index.save()
+      report_metrics(args, log=log)
       log.warning("--- Ending Cleanup --- Freed " + convert_size(freed))
     else:
       log.info("--- Starting Cleanup in Interactive Mode ---")
+      groups = registry.menu_groups()
+      scanner = BackgroundScanner(log=log)
+      for category in registry.categories():
+        scanner.scan(category)
+
+      extended_menu = {}
+      submenus = {}
+      actions = {}
+      for key, entries in groups:
+        extended_menu[key + 's'] = entries[0]['show']
+        actions[key.lower() + 's'] = ('show', entries)
+        actions[key.lower() + 'r'] = ('reload', entries)
+        if entries[0]['choice'] is None:
+          actions[key.lower()] = ('clean', entries[0])
+          continue
+        submenus[key.lower()] = (key, entries)
+        for entry in entries:
+          actions[(key + entry['choice'][0]).lower()] = ('clean', entry)
+      extended_menu['R']  = "Reload (Nr to reload option N only)"
+
+      # Sizes are those known when the menu is drawn
+      def size(entry):
+        return scanner.pretty_size(registry.get(entry['id']))
+
+      def build_menu():
+        menu = {}
+        for key, entries in groups:
+          label = entries[0]['label'] if entries[0]['choice'] is None else entries[0]['group'] or entries[0]['help']
+          menu[key] = "%s (%s)" % (label, size(entries[0]))
+        menu[JOURNAL_MENU] = "Vacuum system journal"
+        menu["="] = "=============================================================="
+        menu['A'] = "Clean all (A! to also remove current logs)"
+        menu['M'] = "More options"
+        menu['Q'] = "Exit"
+        return menu
+
+      def build_submenu(key, entries):
+        return dict((key + entry['choice'][0], "%s (%s)" % (entry['label'], size(entry))) for entry in entries)
+
       while True:
-          os.system('clear')
-          menu = {}
-          menu['0'] = "Clean old system logs (" + system_logs.pretty_size + ")"
-          menu['1'] = "Clean system crash files (" + system_crash_files.pretty_size + ")"
-          menu['2'] = "Clean Rotated CVP logs (" + cvp_logs.pretty_size + ")"
-          menu['3'] = "Clean Current CVP logs (" + cvp_current_logs.pretty_size + ")"
-          menu['4'] = "Clean CVP docker images (" + cvp_docker_images.pretty_size + ")"
-          menu['5'] = "Clean CVP RPMs (" + cvp_rpms.pretty_size + ")"
-          menu['6'] = "Clean Elasticsearch Heap Dumps (" + cvp_elasticsearch_heap_dumps.pretty_size + ")"
-          menu['7'] = "Clean CVP temporary upgrade directories (" + cvp_tmp_upgrade.pretty_size + ")"
-          menu['8'] = "Vacuum system journal"
-          menu['9'] = "Clean kubelet logs (" + kubelet_logs['all'].pretty_size + ")"
-          menu['10'] = "Clean Zookeeper Heap Dumps (" + cvp_clickhouse_zk_heap_dump.pretty_size + ")"
-          menu["="] = "=============================================================="
-          menu['A'] = "Clean all (A! to also remove current logs)"
-          menu['M'] = "More options"
-          menu['Q'] = "Exit"
-
-          extended_menu = {}
-          extended_menu['0s'] = "Show old system log files"
-          extended_menu['1s'] = "Show old system crash files"
-          extended_menu['2s'] = "Show Rotated CVP log files"
-          extended_menu['3s'] = "Show Current CVP log files"
-          extended_menu['4s'] = "Show CVP docker images"
-          extended_menu['5s'] = "Show CVP RPM files"
-          extended_menu['6s'] = "Show Elasticsearch heap dumps files"
-          extended_menu['7s'] = "Show temporary upgrade files"
-          extended_menu['9s'] = "Show Kubelet logs"
-          extended_menu['R']  = "Reload"
-
-          kubelet_menu = {}
-          kubelet_menu['9a'] = "Clean all kubelet logs (" + kubelet_logs['all'].pretty_size + ")"
-          kubelet_menu['9i'] = "Clean kubelet info logs (" + kubelet_logs['info'].pretty_size + ")"
-          kubelet_menu['9w'] = "Clean kubelet warning logs (" + kubelet_logs['warning'].pretty_size + ")"
-          kubelet_menu['9e'] = "Clean kubelet error logs (" + kubelet_logs['error'].pretty_size + ")"
-
-          selection = showMenu(menu)
+          selection = showLiveMenu(build_menu, scanner)
 
           if selection.lower() == 'm':
               selection = showMenu(extended_menu)
-          elif selection == '9':
-              selection = showMenu(kubelet_menu)
+          elif selection.lower() in submenus:
+              selection = showMenu(build_submenu(*submenus[selection.lower()]))
 
-          if selection == '0':
-              freed = system_logs.delete_files()
-              message = "System logs - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '0s':
-              print(system_logs.list())
-          elif selection == '1':
-              freed = system_crash_files.delete_files()
-              message = "System crash files - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '1s':
-              print(system_crash_files.list())
-          elif selection == '2':
-              freed = cvp_logs.delete_files()
-              message = "CVP Rotated logs - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '2s':
-              print(cvp_logs.list())
-          elif selection == '3':
-              print("WARNING! This may remove files that may be useful to debug issues.")
-              freed = cvp_current_logs.delete_files()
-              message = "CVP Current logs - Freed %s.\nPlease restart CVP to free up space used by open log files." % convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '3s':
-              print(cvp_current_logs.list())
-          elif selection == '4':
-              freed = cvp_docker_images.delete_files()
-              message = "CVP docker images - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '4s':
-              print(cvp_docker_images.list())
-          elif selection == '5':
-              freed = cvp_rpms.delete_files()
-              message = "CVP RPMs - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '5s':
-              print(cvp_rpms.list())
-          elif selection == '6':
-              freed = cvp_elasticsearch_heap_dumps.delete_files()
-              message = "CVP Elasticsearch Heap Dumps - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '6s':
-              print(cvp_elasticsearch_heap_dumps.list())
-          elif selection == '7':
-              freed = cvp_tmp_upgrade.delete_files()
-              message = "CVP temporary upgrade files - Freed " + convert_size(freed)
+          action = actions.get(selection.lower())
+          if action is not None and action[0] == 'clean':
+              entry = action[1]
+              category = registry.get(entry['id'])
+              if entry['in_use']:
+                print("WARNING! This may remove files that may be useful to debug issues.")
+                freed = category.delete_files()
+                reclaimed, failed = open_files.reclaim(category.get_roots())
+                message = "%s - Freed %s (%s reclaimed from open log files)." % (category.name, convert_size(freed), convert_size(reclaimed))
+                if failed:
+                  message += "\nPlease restart CVP to free up space used by open log files."
+              else:
+                freed = category.delete_files()
+                message = "%s - Freed %s" % (category.name, convert_size(freed))
+              # Look for files that showed up meanwhile, without holding up the menu
+              scanner.refresh(category)
               log.info(message)
               print(message)
-          elif selection == '7s':
-              print(cvp_tmp_upgrade.list())
-          elif selection == '8':
+          elif action is not None and action[0] == 'show':
+              entries = action[1]
+              if len(entries) == 1:
+                print(registry.get(entries[0]['id']).list())
+              # The first choice of a group covers the others, list them one by one
+              for entry in entries[1:]:
+                print("--- %s ---" % entry['choice'].capitalize())
+                print(registry.get(entry['id']).list())
+          elif action is not None and action[0] == 'reload':
+              for entry in action[1]:
+                scanner.refresh(registry.get(entry['id']))
+              continue
+          elif selection == JOURNAL_MENU:
               vacuum_time = input("How many days to keep on the journal? (Default: 2 days)\n")
               if vacuum_time:
-                freed = clean_system_journal(vacuum_time=vacuum_time, log=log)
+                freed = clean_system_journal(vacuum_time=vacuum_time, vacuum_size=args.vacuum_size, vacuum_files=args.vacuum_files, compression=args.journal_compression, log=log)
               else:
-                freed = clean_system_journal(log=log)
+                freed = clean_system_journal(vacuum_size=args.vacuum_size, vacuum_files=args.vacuum_files, compression=args.journal_compression, log=log)
               message = "System journal vacuum - Freed " + convert_size(freed)
               log.info(message)
               print(message)
-          elif selection.lower() == '9a':
-              freed = kubelet_logs['all'].delete_files()
-              message = "Kubelet logs - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection.lower() == '9i':
-              freed = kubelet_logs['info'].delete_files()
-              message = "Kubelet logs (info) - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection.lower() == '9w':
-              freed = kubelet_logs['warning'].delete_files()
-              message = "Kubelet logs (warning) - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection.lower() == '9e':
-              freed = kubelet_logs['error'].delete_files()
-              message = "Kubelet logs (error) - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection.lower() == '9s':
-              print("--- Info ---")
-              print(kubelet_logs['info'].list())
-              print("--- Warning ---")
-              print(kubelet_logs['warning'].list())
-              print("--- Error ---")
-              print(kubelet_logs['error'].list())
-          elif selection == '10':
-              freed = cvp_clickhouse_zk_heap_dump.delete_files()
-              message = "CVP Zookeeper Heap Dumps - Freed " + convert_size(freed)
-              log.info(message)
-              print(message)
-          elif selection == '10s':
-              print(cvp_clickhouse_zk_heap_dump.list())
-              
           elif selection.lower() == 'a' or selection.lower() == 'a!':
               if selection.lower() == 'a!':
                 print("WARNING! This may remove files that may be useful to debug issues.")
               vacuum_time = input("How many days to keep on the journal? (Default: 2 days)\n")
-              freed = system_logs.delete_files()
-              freed += system_crash_files.delete_files()
-              freed += cvp_logs.delete_files()
-              if selection.lower() == 'a!':
-                freed += cvp_current_logs.delete_files()
-                message = "Please restart CVP to free up space used by open log files."
-                print(message)
-              freed += cvp_docker_images.delete_files()
-              freed += cvp_rpms.delete_files()
-              freed += cvp_elasticsearch_heap_dumps.delete_files()
-              freed += cvp_clickhouse_zk_heap_dump.delete_files()
-              freed += cvp_tmp_upgrade.delete_files()
-              freed += kubelet_logs['all'].delete_files()
+              freed = 0
+              for entry in registry.entries:
+                category = registry.get(entry['id'])
+                if entry['clean_all']:
+                  freed += category.delete_files()
+                  scanner.refresh(category)
+                elif entry['in_use'] and selection.lower() == 'a!':
+                  freed += category.delete_files()
+                  scanner.refresh(category)
+                  reclaimed, failed = open_files.reclaim(category.get_roots())
+                  if failed:
+                    message = "Please restart CVP to free up space used by open log files."
+                    print(message)
               if vacuum_time:
-                freed += clean_system_journal(vacuum_time=vacuum_time, log=log)
+                freed += clean_system_journal(vacuum_time=vacuum_time, vacuum_size=args.vacuum_size, vacuum_files=args.vacuum_files, compression=args.journal_compression, log=log)
               else:
-                freed += clean_system_journal(log=log)
+                freed += clean_system_journal(vacuum_size=args.vacuum_size, vacuum_files=args.vacuum_files, compression=args.journal_compression, log=log)
               message = "Full cleanup - Freed %s." %convert_size(freed)
               log.info(message)
               print(message)
           elif selection.lower() == 'q':
+            with index.lock:
+              index.save()
             log.info("--- Ending Interactive Cleanup ---")
             break
           elif selection.lower() == 'r':
-            main()
-            break
-          elif selection.lower() == 'm' or selection.lower() == '9':
+            for category in registry.categories():
+              scanner.refresh(category)
+            continue
+          elif selection.lower() == 'm' or selection.lower() in submenus:
               pass
           else:
               print("Unknown option %s." %selection)